@@ -20,12 +20,9 @@ Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import sys
 import os
-import subprocess
-import time
-import atexit
 import configparser
-import psutil
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -41,8 +38,8 @@ from PyQt5.QtWidgets import (
     QTextEdit,
     QLabel,
 )
-from PyQt5.QtCore import Qt, QSize, QFileInfo, QTimer, QThread, pyqtSignal
-from PyQt5.QtGui import QIcon, QDragEnterEvent, QDropEvent, QPainter, QColor, QFont
+from PyQt5.QtCore import Qt, QSize, QFileInfo, QTimer, QThread, QObject, pyqtSignal
+from PyQt5.QtGui import QIcon, QImage, QPixmap, QDragEnterEvent, QDropEvent, QPainter, QColor, QFont
 from PyQt5.QtWidgets import QGraphicsDropShadowEffect
 from PyQt5.QtWidgets import QStyle
 
@@ -52,51 +49,21 @@ try:
 except ImportError:
     windows_taskbar_available = False
 
-temp_files = set()
-ffmpeg_processes = set()
-
-def cleanup_temp_files(silent=True):
-    for temp_file in list(temp_files):
-        if os.path.exists(temp_file):
-            for _ in range(5):
-                try:
-                    os.remove(temp_file)
-                    temp_files.discard(temp_file)
-                    break
-                except Exception:
-                    time.sleep(0.1)
-    for temp_file in os.listdir('.'):
-        if temp_file.startswith('temp_thumb_') and os.path.isfile(temp_file):
-            for _ in range(5):
-                try:
-                    os.remove(temp_file)
-                    break
-                except Exception:
-                    time.sleep(0.1)
-
-def terminate_ffmpeg_processes():
-    for pid in list(ffmpeg_processes):
-        try:
-            process = psutil.Process(pid)
-            for child in process.children(recursive=True):
-                try:
-                    child.terminate()
-                    child.wait(1)
-                    if child.is_running():
-                        child.kill()
-                except psutil.NoSuchProcess:
-                    pass
-            process.terminate()
-            process.wait(1)
-            if process.is_running():
-                process.kill()
-            ffmpeg_processes.discard(pid)
-        except psutil.NoSuchProcess:
-            ffmpeg_processes.discard(pid)
-
-atexit.register(cleanup_temp_files)
-atexit.register(terminate_ffmpeg_processes)
-cleanup_temp_files()
+from morph_core import (
+    terminate_ffmpeg_processes,
+    get_thumbnail,
+    media_cache,
+    encoding_profiles,
+    default_profile,
+    load_profiles,
+    parse_ico_sizes,
+    conversion_functions,
+    BatchJournal,
+    MetricsRecorder,
+    ResultCache,
+    BatchConverter,
+)
+from morph_server import ConversionQueue, JobServer
 
 translations = {
     "ru": {
@@ -110,7 +77,6 @@ translations = {
         "clear": "Очистить",
         "converting": "Конвертация: {progress}%",
         "select_type_format": "Выберите тип и формат конвертации!",
-        "collect_files_error": "Ошибка при сборе файлов: {error}",
         "no_valid_files": "Нет подходящих файлов",
         "file_access_error": "Ошибка доступа к файлу: {file}",
         "conversion_error": "Ошибка конвертации: {file}",
@@ -121,6 +87,11 @@ translations = {
         "drag_drop": "ПЕРЕТАЩИТЕ ФАЙЛЫ\nСЮДА",
         "conversion_success": "Конвертация завершена успешно",
         "conversion_failed": "Конвертация не удалась: {failed} из {total} файлов не удалось конвертировать",
+        "resume": "Продолжить ({count})",
+        "profile": "Профиль: {name}",
+        "scan_progress": "Найдено файлов: {found}, в очереди: {queued}",
+        "formats_selected": "Форматы: {formats} (Ctrl+клик добавляет или убирает формат)",
+        "stream_report": "Без перекодирования: {remuxed}, перекодировано: {encoded} (скопировано потоков: {copied}, пропущено: {dropped})",
     },
     "en": {
         "window_title": "Morph",
@@ -133,7 +104,6 @@ translations = {
         "clear": "Clear",
         "converting": "Converting: {progress}%",
         "select_type_format": "Select type and format for conversion!",
-        "collect_files_error": "Error collecting files: {error}",
         "no_valid_files": "No valid files found",
         "file_access_error": "Error accessing file: {file}",
         "conversion_error": "Error converting: {file}",
@@ -144,446 +114,95 @@ translations = {
         "drag_drop": "DRAG &\nDROP",
         "conversion_success": "Conversion completed successfully",
         "conversion_failed": "Conversion failed: {failed} of {total} files failed to convert",
+        "resume": "Resume ({count})",
+        "profile": "Profile: {name}",
+        "scan_progress": "Files found: {found}, queued: {queued}",
+        "formats_selected": "Formats: {formats} (Ctrl+click adds or removes a format)",
+        "stream_report": "Remuxed: {remuxed}, re-encoded: {encoded} (streams copied: {copied}, dropped: {dropped})",
     }
 }
 
-def get_binary_path(binary_name):
-    try:
-        if getattr(sys, "frozen", False):
-            base_path = sys._MEIPASS
-        else:
-            base_path = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.join(base_path, "bin", binary_name)
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"Binary {binary_name} not found at {path}")
-        return path
-    except Exception as e:
-        raise
-
-ffmpeg_path = get_binary_path("ffmpeg.exe")
-magick_path = get_binary_path("magick.exe")
-exiftool_path = get_binary_path("exiftool.exe")
-ffprobe_path = get_binary_path("ffprobe.exe")
-
-video_extensions = [".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".ts", ".mpeg", ".vob", ".m2ts", ".bdav", ".mpg"]
-audio_extensions = [".mp3", ".wav", ".m4a", ".flac", ".ogg", ".aac", ".wma", ".opus"]
-image_extensions = [".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tiff", ".webp", ".jxr", ".heic", ".avif", ".ico", ".dng"]
-
-def generate_thumbnail(file_path):
-    if not os.path.exists(file_path):
-        return None
-    ext = os.path.splitext(file_path)[1].lower()
-    temp_thumb = f"temp_thumb_{int(time.time()*1000)}_{os.path.basename(file_path)}.png"
-    temp_files.add(temp_thumb)
-    icon = None
-    try:
-        if ext in video_extensions:
-            cmd = f'"{ffmpeg_path}" -i "{file_path}" -vf "thumbnail,scale=64:64" -frames:v 1 "{temp_thumb}" -y'
-            process = subprocess.run(
-                cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            if process.returncode == 0 and os.path.exists(temp_thumb):
-                icon = QIcon(temp_thumb)
-        elif ext in image_extensions:
-            cmd = f'"{ffmpeg_path}" -i "{file_path}" -vf "scale=64:64" -frames:v 1 "{temp_thumb}" -y'
-            process = subprocess.run(
-                cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            if process.returncode == 0 and os.path.exists(temp_thumb):
-                icon = QIcon(temp_thumb)
-        elif ext in audio_extensions:
-            cmd = f'"{ffmpeg_path}" -i "{file_path}" -an -vcodec copy "{temp_thumb}" -y'
-            process = subprocess.run(
-                cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            if process.returncode == 0 and os.path.exists(temp_thumb):
-                icon = QIcon(temp_thumb)
-    except subprocess.CalledProcessError:
-        pass
-    finally:
-        if os.path.exists(temp_thumb):
-            for _ in range(5):
-                try:
-                    os.remove(temp_thumb)
-                    temp_files.discard(temp_thumb)
-                    break
-                except Exception:
-                    time.sleep(0.1)
-    return icon
-
-def convert_video_to_mp4(input_path, output_path, progress_callback):
-    cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0:v:0? -map 0:a? -map 0:s? -map 0:t? -map -0:d -c:v libx264 -profile:v high444 -pix_fmt yuv444p -crf 18 -preset medium -c:a aac -b:a 320k -c:s copy -c:t copy -map_metadata 0 -fflags +genpts -movflags +faststart -progress pipe:1 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        duration = get_duration(input_path)
-        while process.poll() is None:
-            line = process.stdout.readline().strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    current_time = int(line.split("=")[1]) / 1000000
-                    if duration > 0:
-                        progress = min((current_time / duration) * 100, 100)
-                        progress_callback(progress)
-                except (ValueError, IndexError):
-                    pass
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def convert_video_to_mkv(input_path, output_path, progress_callback):
-    cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0 -map -0:d -c:v copy -c:a copy -c:s copy -c:t copy -map_metadata 0 -fflags +genpts -progress pipe:1 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        duration = get_duration(input_path)
-        while process.poll() is None:
-            line = process.stdout.readline().strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    current_time = int(line.split("=")[1]) / 1000000
-                    if duration > 0:
-                        progress = min((current_time / duration) * 100, 100)
-                        progress_callback(progress)
-                except (ValueError, IndexError):
-                    pass
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def convert_video_to_webm(input_path, output_path, progress_callback):
-    cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0:v? -map 0:a? -map 0:s? -c:v libvpx-vp9 -crf 18 -b:v 0 -deadline good -auto-alt-ref 0 -c:a libopus -b:a 320k -c:s copy -map_metadata 0 -fflags +genpts -threads 4 -progress pipe:1 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        duration = get_duration(input_path)
-        while process.poll() is None:
-            line = process.stdout.readline().strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    current_time = int(line.split("=")[1]) / 1000000
-                    if duration > 0:
-                        progress = min((current_time / duration) * 100, 100)
-                        progress_callback(progress)
-                except (ValueError, IndexError):
-                    pass
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def get_duration(input_path):
-    cmd = f'"{ffprobe_path}" -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 "{input_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        ffmpeg_processes.add(process.pid)
-        output = process.communicate()[0].decode().strip()
-        ffmpeg_processes.discard(process.pid)
+class ThumbnailLoader(QObject):
+    thumbnail_ready = pyqtSignal(str, QImage)
+
+    def __init__(self, max_workers=4):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def request(self, path):
+        self.executor.submit(self.load, path)
+
+    def load(self, path):
         try:
-            return float(output)
-        except ValueError:
-            return 0.0
-    except (subprocess.CalledProcessError, ValueError):
-        return 0.0
-
-def get_audio_codec(input_path):
-    cmd = f'"{ffprobe_path}" -v error -select_streams a:0 -show_entries stream=codec_name -of default=nw=1:nk=1 "{input_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        ffmpeg_processes.add(process.pid)
-        output = process.communicate()[0].decode().strip()
-        ffmpeg_processes.discard(process.pid)
-        return output
-    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-        return ""
-
-def convert_audio_to_m4a(input_path, output_path, progress_callback):
-    codec = get_audio_codec(input_path)
-    if codec in ["aac", "alac"]:
-        cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0 -c copy -map_metadata 0 -progress pipe:1 "{output_path}"'
-    else:
-        cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0 -c:a alac -c:v copy -map_metadata 0 -progress pipe:1 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        duration = get_duration(input_path)
-        while process.poll() is None:
-            line = process.stdout.readline().strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    current_time = int(line.split("=")[1]) / 1000000
-                    if duration > 0:
-                        progress = min((current_time / duration) * 100, 100)
-                        progress_callback(progress)
-                except (ValueError, IndexError):
-                    pass
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def convert_audio_to_flac(input_path, output_path, progress_callback):
-    codec = get_audio_codec(input_path)
-    if codec == "flac":
-        cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0 -c copy -map_metadata 0 -progress pipe:1 "{output_path}"'
-    else:
-        cmd = f'"{ffmpeg_path}" -i "{input_path}" -map 0 -c:a flac -c:v copy -map_metadata 0 -progress pipe:1 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        duration = get_duration(input_path)
-        while process.poll() is None:
-            line = process.stdout.readline().strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    current_time = int(line.split("=")[1]) / 1000000
-                    if duration > 0:
-                        progress = min((current_time / duration) * 100, 100)
-                        progress_callback(progress)
-                except (ValueError, IndexError):
-                    pass
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def convert_image_to_ico(input_path, output_path, progress_callback):
-    cmd = f'"{ffmpeg_path}" -i "{input_path}" -vf scale=256:256 -frames:v 1 -map_metadata 0 "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        while process.poll() is None:
-            progress_callback(50)
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
-
-def convert_image_to_jpg(input_path, output_path, progress_callback):
-    try:
-        density = subprocess.check_output(
-            f'"{magick_path}" identify -format "%x" "{input_path}"',
-            shell=True,
-            creationflags=0x08000000
-        ).decode().strip()
-        cmd = f'"{magick_path}" "{input_path}" -strip -quality 95 -density {density} "{output_path}"'
-        process = subprocess.Popen(
-            cmd, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        while process.poll() is None:
-            progress_callback(50)
-            QApplication.processEvents()
-        result = subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr="")
-        return result
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd if 'cmd' in locals() else "", returncode=1, stdout="", stderr=str(e))
-
-def convert_image_to_png(input_path, output_path, progress_callback):
-    cmd1 = f'"{ffmpeg_path}" -i "{input_path}" -c:v png -frames:v 1 -pix_fmt rgba "{output_path}"'
-    try:
-        process = subprocess.Popen(
-            cmd1, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        ffmpeg_processes.add(process.pid)
-        while process.poll() is None:
-            progress_callback(50)
-            QApplication.processEvents()
-        ffmpeg_processes.discard(process.pid)
-        result1 = subprocess.CompletedProcess(args=cmd1, returncode=process.returncode, stdout="", stderr="")
-        if result1.returncode != 0:
-            return result1
-        cmd2 = f'"{exiftool_path}" -tagsfromfile "{input_path}" -all:all -XResolution -YResolution -ResolutionUnit -BitsPerSample -overwrite_original "{output_path}"'
-        process = subprocess.Popen(
-            cmd2, shell=True, creationflags=0x08000000, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8'
-        )
-        while process.poll() is None:
-            progress_callback(75)
-            QApplication.processEvents()
-        result2 = subprocess.CompletedProcess(args=cmd2, returncode=process.returncode, stdout="", stderr="")
-        return result2
-    except Exception as e:
-        return subprocess.CompletedProcess(args=cmd1 if 'cmd1' in locals() else "", returncode=1, stdout="", stderr=str(e))
-
-conversion_functions = {
-    "Video": {"MP4": convert_video_to_mp4, "MKV": convert_video_to_mkv, "WebM": convert_video_to_webm},
-    "Audio": {"M4A": convert_audio_to_m4a, "FLAC": convert_audio_to_flac},
-    "Image": {"ICO": convert_image_to_ico, "JPG": convert_image_to_jpg, "PNG": convert_image_to_png},
-}
+            data = get_thumbnail(path)
+        except Exception:
+            return
+        if data:
+            image = QImage.fromData(data)
+            if not image.isNull():
+                self.thumbnail_ready.emit(path, image)
 
-def is_valid_file(file_path, conversion_type):
-    if not os.path.exists(file_path):
-        return False
-    ext = os.path.splitext(file_path)[1].lower()
-    return ext in (
-        video_extensions if conversion_type == "Video" else
-        audio_extensions if conversion_type == "Audio" else
-        image_extensions
-    )
-
-def get_output_file(input_file, extension):
-    base_name = os.path.splitext(input_file)[0]
-    output_file = f"{base_name}.{extension.lower()}"
-    suffix = 1
-    while os.path.exists(output_file):
-        output_file = f"{base_name}_{suffix}.{extension.lower()}"
-        suffix += 1
-    return output_file
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 class ConversionThread(QThread):
     progress_signal = pyqtSignal(float)
     error_signal = pyqtSignal(str, dict)
     completed_signal = pyqtSignal(int, int)
+    report_signal = pyqtSignal(dict)
+    scan_signal = pyqtSignal(int, int)
 
-    def __init__(self, files, conversion_type, selected_format, conversion_func, language):
+    def __init__(self, files, conversion_type, selected_format, language, max_workers=0, settings=None, journal=None, resume=False, metrics=None, result_cache=None, conversion_queue=None):
         super().__init__()
         self.files = files
+        self.conversion_queue = conversion_queue
+        self.batch = None
+        self.resume = resume
         self.conversion_type = conversion_type
         self.selected_format = selected_format
-        self.conversion_func = conversion_func
         self.language = language
-        self.process = None
-        self.is_cancelled = False
+        self.converter = BatchConverter(
+            conversion_type,
+            selected_format,
+            max_workers,
+            progress_callback=self.progress_signal.emit,
+            error_callback=self.error_signal.emit,
+            journal=journal,
+            metrics=metrics,
+            result_cache=result_cache,
+            scan_callback=self.scan_signal.emit,
+            **(settings or {}),
+        )
+
+    @property
+    def is_cancelled(self):
+        return self.converter.is_cancelled
 
     def stop(self):
-        self.is_cancelled = True
-        if self.process:
-            try:
-                process = psutil.Process(self.process.pid)
-                for child in process.children(recursive=True):
-                    try:
-                        child.terminate()
-                        child.wait(2)
-                        if child.is_running():
-                            child.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-                process.terminate()
-                process.wait(2)
-                if process.is_running():
-                    process.kill()
-                ffmpeg_processes.discard(self.process.pid)
-            except psutil.NoSuchProcess:
-                pass
-            self.process = None
-        terminate_ffmpeg_processes()
-        cleanup_temp_files()
+        if self.batch:
+            self.conversion_queue.cancel(self.batch.id)
+        else:
+            self.converter.stop()
 
     def run(self):
-        total_files = len(self.files)
-        processed_files = 0
-        failed_files = 0
-
-        for input_file in self.files:
-            if self.is_cancelled:
-                break
-            if not os.path.exists(input_file):
-                failed_files += 1
-                processed_files += 1
-                self.error_signal.emit("file_access_error", {"file": input_file})
-                self.progress_signal.emit((processed_files / total_files) * 100 if total_files > 0 else 100)
-                continue
-
-            output_file = get_output_file(input_file, self.selected_format)
-            
-            try:
-                with open(input_file, 'rb') as f:
-                    pass
-                output_dir = os.path.dirname(output_file)
-                if not os.access(output_dir, os.W_OK):
-                    raise PermissionError(f"No write permission to directory: {output_dir}")
-            except Exception as e:
-                failed_files += 1
-                processed_files += 1
-                self.error_signal.emit("file_access_error", {"file": input_file})
-                self.progress_signal.emit((processed_files / total_files) * 100 if total_files > 0 else 100)
-                continue
-
-            file_progress_start = (processed_files / total_files) * 100
-            file_progress_end = ((processed_files + 1) / total_files) * 100
-
-            try:
-                def progress_callback(progress):
-                    if self.is_cancelled:
-                        return
-                    file_progress = file_progress_start + (progress / 100) * (file_progress_end - file_progress_start)
-                    self.progress_signal.emit(min(file_progress, 100))
-
-                result = self.conversion_func(input_path=input_file, output_path=output_file, progress_callback=progress_callback)
-                self.process = None
-                if self.is_cancelled:
-                    if os.path.exists(output_file):
-                        try:
-                            os.remove(output_file)
-                        except Exception:
-                            pass
-                    break
-                if result.returncode != 0:
-                    failed_files += 1
-                    self.error_signal.emit("conversion_error", {"file": input_file})
-                    if os.path.exists(output_file):
-                        try:
-                            os.remove(output_file)
-                        except Exception:
-                            pass
-                    processed_files += 1
-                    self.progress_signal.emit(file_progress_end)
-                elif not os.path.exists(output_file):
-                    failed_files += 1
-                    self.error_signal.emit("output_not_created", {"file": output_file})
-                    if os.path.exists(output_file):
-                        try:
-                            os.remove(output_file)
-                        except Exception:
-                            pass
-                    processed_files += 1
-                    self.progress_signal.emit(file_progress_end)
-                else:
-                    processed_files += 1
-                    self.progress_signal.emit(file_progress_end)
-            except Exception as e:
-                failed_files += 1
-                self.error_signal.emit("conversion_error", {"file": input_file})
-                if os.path.exists(output_file):
-                    try:
-                        os.remove(output_file)
-                    except Exception:
-                        pass
-                processed_files += 1
-                self.progress_signal.emit(file_progress_end)
-            QApplication.processEvents()
-        
+        if self.conversion_queue:
+            # Jobs submitted over the API share the queue and run in turn.
+            # The window's own batch waits only for normal-priority jobs,
+            # whatever priority its encoders run at.
+            self.batch = self.conversion_queue.submit(self.converter, self.files, self.resume, source="gui", priority="normal")
+            self.batch.done.wait()
+            jobs = self.converter.jobs
+        else:
+            jobs = self.converter.run(self.files, self.resume)
+        failed_files = self.converter.failed_files
+        total_files = len(jobs)
+        report = self.converter.plan_report()
+        if report:
+            self.report_signal.emit(report)
         if self.is_cancelled:
             self.error_signal.emit("conversion_cancelled", {})
+        elif total_files == 0:
+            self.error_signal.emit("no_valid_files", {})
         elif failed_files != 0:
             if failed_files == total_files:
                 self.error_signal.emit("conversion_failed", {"failed": failed_files, "total": total_files})
@@ -838,7 +457,22 @@ class MorphWindow(QMainWindow):
             QLabel { color: #999999; }
         """)
         self.setAcceptDrops(True)
+        try:
+            if self.config.getboolean("Settings", "probe_cache", fallback=True):
+                media_cache.enable_persistence("probe_cache.json")
+        except Exception:
+            pass
+        load_profiles("profiles.ini")
+        try:
+            self.profile = self.config.get("Settings", "profile", fallback=default_profile)
+        except Exception:
+            self.profile = default_profile
+        if self.profile not in encoding_profiles:
+            self.profile = default_profile
         self.icon_provider = QFileIconProvider()
+        self.thumbnail_items = {}
+        self.thumbnail_loader = ThumbnailLoader()
+        self.thumbnail_loader.thumbnail_ready.connect(self.set_thumbnail)
 
         self.taskbar_button = None
         if windows_taskbar_available and sys.platform == "win32":
@@ -870,6 +504,15 @@ class MorphWindow(QMainWindow):
 
         top_layout.addStretch()
 
+        self.resume_button = QPushButton()
+        self.resume_button.setVisible(False)
+        self.resume_button.clicked.connect(self.resume_conversion)
+        top_layout.addWidget(self.resume_button)
+
+        self.profile_button = QPushButton(translations[self.language]["profile"].format(name=self.profile))
+        self.profile_button.clicked.connect(self.toggle_profile)
+        top_layout.addWidget(self.profile_button)
+
         self.clear_all_button = QPushButton(translations[self.language]["clear_all"])
         self.clear_all_button.clicked.connect(self.clear_files)
         top_layout.addWidget(self.clear_all_button)
@@ -967,12 +610,20 @@ class MorphWindow(QMainWindow):
 
         self.conversion_type = None
         self.selected_format = None
+        self.extra_formats = []
         self.active_type_button = None
         self.active_format_button = None
         self.conversion_thread = None
         self.status_key = None
         self.status_params = None
+        self.stream_report = None
+        self.journal = BatchJournal("morph_journal.jsonl")
+        self.metrics = self.get_metrics_recorder()
+        self.result_cache = self.get_result_cache()
+        self.conversion_queue = ConversionQueue()
+        self.job_server = self.start_job_server()
         self.update_drag_drop_label()
+        self.update_resume_button()
 
     def _showEvent(self, event):
         super().showEvent(event)
@@ -995,8 +646,13 @@ class MorphWindow(QMainWindow):
                 message = translations[self.language][key]
         else:
             message = key
+        if self.stream_report and key in ("conversion_success", "completed_with_errors"):
+            message += "\n" + translations[self.language]["stream_report"].format(**self.stream_report)
         self.status_text.setText(message)
 
+    def set_stream_report(self, report):
+        self.stream_report = report
+
     def toggle_language(self):
         old_language = self.language
         self.language = "en" if self.language == "ru" else "ru"
@@ -1004,6 +660,8 @@ class MorphWindow(QMainWindow):
         self.language_button.setText("EN" if self.language == "ru" else "RU")
         self.setWindowTitle(translations[self.language]["window_title"])
         self.clear_all_button.setText(translations[self.language]["clear_all"])
+        self.update_resume_button()
+        self.profile_button.setText(translations[self.language]["profile"].format(name=self.profile))
         self.video_button.setText(translations[self.language]["video"])
         self.audio_button.setText(translations[self.language]["audio"])
         self.image_button.setText(translations[self.language]["image"])
@@ -1019,29 +677,8 @@ class MorphWindow(QMainWindow):
         if self.status_key:
             self.set_status_message(self.status_key, self.status_params)
         if self.conversion_type and self.selected_format:
-            formats = list(conversion_functions[self.conversion_type].keys())
-            self.clear_format_layout()
-            for fmt in formats:
-                button = QPushButton(fmt)
-                button.clicked.connect(lambda _, f=fmt: self.select_format(f))
-                self.format_layout.addWidget(button)
-                if fmt == self.selected_format:
-                    self.active_format_button = button
-                    effect = QGraphicsDropShadowEffect()
-                    effect.setColor(QColor("#000000"))
-                    effect.setOffset(2, 2)
-                    effect.setBlurRadius(10)
-                    button.setGraphicsEffect(effect)
-                    button.setStyleSheet(""" 
-                        QPushButton {
-                            background-color: #4CAF50;
-                            color: #ffffff;
-                            border: none;
-                            padding: 15px;
-                            border-radius: 5px;
-                            font-size: 16px;
-                        }
-                    """)
+            self.show_format_buttons(list(conversion_functions[self.conversion_type].keys()))
+            self.update_format_buttons()
         self.update_drag_drop_label()
         try:
             if not self.config.has_section("Settings"):
@@ -1052,6 +689,19 @@ class MorphWindow(QMainWindow):
         except Exception:
             pass
 
+    def toggle_profile(self):
+        names = list(encoding_profiles)
+        self.profile = names[(names.index(self.profile) + 1) % len(names)]
+        self.profile_button.setText(translations[self.language]["profile"].format(name=self.profile))
+        try:
+            if not self.config.has_section("Settings"):
+                self.config.add_section("Settings")
+            self.config.set("Settings", "profile", self.profile)
+            with open(self.config_file, "w", encoding="utf-8") as configfile:
+                self.config.write(configfile)
+        except Exception:
+            pass
+
     def handle_key_press(self, event):
         if event.key() == Qt.Key_Delete:
             self.remove_selected_files()
@@ -1076,6 +726,7 @@ class MorphWindow(QMainWindow):
 
     def clear_files(self):
         self.file_list.clear()
+        self.thumbnail_items.clear()
         self.status_text.setText("")
         self.status_key = None
         self.status_params = None
@@ -1122,6 +773,7 @@ class MorphWindow(QMainWindow):
         }[button.text()]
         self.clear_format_layout()
         self.start_button.setVisible(False)
+        self.extra_formats = []
         formats = list(conversion_functions[self.conversion_type].keys())
         self.show_format_buttons(formats)
         self.status_text.setText("")
@@ -1144,25 +796,30 @@ class MorphWindow(QMainWindow):
         self.active_format_button = None
 
     def select_format(self, fmt):
-        if self.active_format_button:
-            self.active_format_button.setStyleSheet(""" 
-                QPushButton {
-                    background-color: #4a4a4a;
-                    color: #ffffff;
-                    border: none;
-                    padding: 15px;
-                    border-radius: 5px;
-                    font-size: 16px;
-                }
-                QPushButton:hover {
-                    background-color: #5a5a5a;
-                }
-            """)
-            self.active_format_button.setGraphicsEffect(None)
+        # Ctrl+click adds further formats, written from the same decode of
+        # each file.
+        if QApplication.keyboardModifiers() & Qt.ControlModifier and self.selected_format in conversion_functions[self.conversion_type] and fmt != self.selected_format:
+            if fmt in self.extra_formats:
+                self.extra_formats.remove(fmt)
+            else:
+                self.extra_formats.append(fmt)
+            self.update_format_buttons()
+            self.set_status_message("formats_selected", {"formats": ", ".join([self.selected_format] + self.extra_formats)})
+            return
+        self.selected_format = fmt
+        self.extra_formats = []
+        self.update_format_buttons()
+        self.start_button.setVisible(True)
+        self.status_text.setText("")
+        self.status_key = None
+        self.status_params = None
 
+    def update_format_buttons(self):
+        self.active_format_button = None
         for i in range(self.format_layout.count()):
             button = self.format_layout.itemAt(i).widget()
-            if button.text() == fmt:
+            fmt = button.text()
+            if fmt == self.selected_format:
                 self.active_format_button = button
                 effect = QGraphicsDropShadowEffect()
                 effect.setColor(QColor("#000000"))
@@ -1179,11 +836,41 @@ class MorphWindow(QMainWindow):
                         font-size: 16px;
                     }
                 """)
-        self.selected_format = fmt
-        self.start_button.setVisible(True)
-        self.status_text.setText("")
-        self.status_key = None
-        self.status_params = None
+            elif fmt in self.extra_formats:
+                button.setGraphicsEffect(None)
+                button.setStyleSheet(""" 
+                    QPushButton {
+                        background-color: #2e6b31;
+                        color: #ffffff;
+                        border: none;
+                        padding: 15px;
+                        border-radius: 5px;
+                        font-size: 16px;
+                    }
+                """)
+            else:
+                button.setGraphicsEffect(None)
+                button.setStyleSheet(""" 
+                    QPushButton {
+                        background-color: #4a4a4a;
+                        color: #ffffff;
+                        border: none;
+                        padding: 15px;
+                        border-radius: 5px;
+                        font-size: 16px;
+                    }
+                    QPushButton:hover {
+                        background-color: #5a5a5a;
+                    }
+                """)
+
+    def set_thumbnail(self, path, image):
+        icon = QIcon(QPixmap.fromImage(image))
+        for item in self.thumbnail_items.pop(path, []):
+            try:
+                item.setIcon(icon)
+            except RuntimeError:
+                pass
 
     def dragEnterEvent(self, event: QDragEnterEvent):
         if event.mimeData().hasUrls():
@@ -1195,15 +882,16 @@ class MorphWindow(QMainWindow):
             path = url.toLocalFile()
             if os.path.exists(path):
                 item = QListWidgetItem(os.path.basename(path))
-                icon = generate_thumbnail(path)
-                if not icon:
-                    file_info = QFileInfo(path)
-                    icon = self.icon_provider.icon(file_info)
-                    if icon.isNull():
-                        icon = QIcon("default_placeholder.png")
+                file_info = QFileInfo(path)
+                icon = self.icon_provider.icon(file_info)
+                if icon.isNull():
+                    icon = QIcon("default_placeholder.png")
                 item.setIcon(icon)
                 item.setData(Qt.UserRole, path)
                 self.file_list.addItem(item)
+                if os.path.isfile(path):
+                    self.thumbnail_items.setdefault(path, []).append(item)
+                    self.thumbnail_loader.request(path)
         self.status_text.setText("")
         self.status_key = None
         self.status_params = None
@@ -1218,42 +906,193 @@ class MorphWindow(QMainWindow):
             self.set_status_message("no_valid_files", {})
             return
 
-        files_to_convert = []
-        total_files = 0
+        # Folders are walked by the conversion thread, which starts on the
+        # first match instead of waiting for the whole walk.
+        paths = [self.file_list.item(i).data(Qt.UserRole) for i in range(self.file_list.count())]
+        files_to_convert = [path for path in paths if os.path.exists(path)]
+        if not files_to_convert:
+            self.set_status_message("no_valid_files", {})
+            return
+
+        self.launch_conversion(files_to_convert, self.conversion_type, self.selected_format, self.get_batch_settings())
+
+    def get_batch_settings(self):
+        try:
+            remux = self.config.getboolean("Settings", "remux", fallback=True)
+        except Exception:
+            remux = True
+        try:
+            batch_size = self.config.getint("Settings", "batch_size", fallback=16)
+        except Exception:
+            batch_size = 16
+        try:
+            segment_parallel = self.config.getboolean("Settings", "segment_parallel", fallback=False)
+        except Exception:
+            segment_parallel = False
+        try:
+            io_workers = self.config.getint("Settings", "io_workers", fallback=0)
+        except Exception:
+            io_workers = 0
+        try:
+            scratch_dir = self.config.get("Settings", "scratch_dir", fallback="")
+        except Exception:
+            scratch_dir = ""
+        try:
+            scratch_quota_mb = self.config.getint("Settings", "scratch_quota_mb", fallback=0)
+        except Exception:
+            scratch_quota_mb = 0
+        try:
+            dedupe = self.config.getboolean("Settings", "dedupe", fallback=True)
+        except Exception:
+            dedupe = True
+        try:
+            full_hash = self.config.getboolean("Settings", "full_hash", fallback=False)
+        except Exception:
+            full_hash = False
+        # Encoders run below normal priority by default so the window stays
+        # responsive during large batches.
+        try:
+            priority = self.config.get("Settings", "priority", fallback="low")
+        except Exception:
+            priority = "low"
+        try:
+            io_priority = self.config.get("Settings", "io_priority", fallback="normal")
+        except Exception:
+            io_priority = "normal"
+        try:
+            pin_cores = self.config.getboolean("Settings", "pin_cores", fallback=False)
+        except Exception:
+            pin_cores = False
+        try:
+            fast_images = self.config.getboolean("Settings", "fast_images", fallback=True)
+        except Exception:
+            fast_images = True
+        try:
+            ico_sizes = parse_ico_sizes(self.config.get("Settings", "ico_sizes", fallback=""))
+        except Exception:
+            ico_sizes = None
+        return {
+            "remux": remux,
+            "batch_size": batch_size,
+            "segment_parallel": segment_parallel,
+            "io_workers": io_workers,
+            "scratch_dir": scratch_dir or None,
+            "scratch_quota_mb": scratch_quota_mb,
+            "profile": self.profile,
+            "dedupe": dedupe,
+            "full_hash": full_hash,
+            "priority": priority,
+            "io_priority": io_priority,
+            "pin_cores": pin_cores,
+            "fast_images": fast_images,
+            "ico_sizes": ico_sizes,
+            "extra_formats": list(self.extra_formats),
+        }
+
+    def get_metrics_recorder(self):
+        try:
+            metrics_dir = self.config.get("Settings", "metrics_dir", fallback="")
+        except Exception:
+            metrics_dir = ""
+        try:
+            metrics_textfile = self.config.get("Settings", "metrics_textfile", fallback="")
+        except Exception:
+            metrics_textfile = ""
+        if not metrics_dir:
+            return None
+        return MetricsRecorder(metrics_dir, metrics_textfile or None)
+
+    def get_result_cache(self):
+        try:
+            cache_dir = self.config.get("Settings", "result_cache_dir", fallback="")
+        except Exception:
+            cache_dir = ""
         try:
-            for i in range(self.file_list.count()):
-                path = self.file_list.item(i).data(Qt.UserRole)
-                if not os.path.exists(path):
-                    continue
-                if os.path.isdir(path):
-                    valid_extensions = (
-                        video_extensions if self.conversion_type == "Video" else
-                        audio_extensions if self.conversion_type == "Audio" else
-                        image_extensions
-                    )
-                    for root, _, files in os.walk(path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            if is_valid_file(file_path, self.conversion_type):
-                                files_to_convert.append(file_path)
-                                total_files += 1
-                elif is_valid_file(path, self.conversion_type):
-                    files_to_convert.append(path)
-                    total_files += 1
-        except Exception as e:
-            self.set_status_message("collect_files_error", {"error": str(e)})
+            cache_mb = self.config.getint("Settings", "result_cache_mb", fallback=2048)
+        except Exception:
+            cache_mb = 2048
+        if not cache_dir:
+            return None
+        return ResultCache(cache_dir, cache_mb)
+
+    def get_api_settings(self):
+        settings = self.get_batch_settings()
+        try:
+            settings["max_workers"] = self.config.getint("Settings", "workers", fallback=0)
+        except Exception:
+            settings["max_workers"] = 0
+        settings["metrics"] = self.metrics
+        settings["result_cache"] = self.result_cache
+        return settings
+
+    def start_job_server(self):
+        # The local job API is off unless a port or socket is configured.
+        try:
+            api_port = self.config.getint("Settings", "api_port", fallback=0)
+        except Exception:
+            api_port = 0
+        try:
+            api_socket = self.config.get("Settings", "api_socket", fallback="")
+        except Exception:
+            api_socket = ""
+        if not api_port and not api_socket:
+            return None
+        job_server = JobServer(self.conversion_queue, self.get_api_settings, api_port, api_socket or None)
+        try:
+            job_server.start()
+        except OSError:
+            return None
+        return job_server
+
+    def update_resume_button(self):
+        if self.conversion_thread and self.conversion_thread.isRunning():
+            self.resume_button.setVisible(False)
             return
+        header, jobs = self.journal.pending_jobs()
+        self.resume_button.setText(translations[self.language]["resume"].format(count=len(jobs)))
+        self.resume_button.setVisible(bool(jobs))
 
-        if total_files == 0:
-            self.set_status_message("no_valid_files", {})
+    def resume_conversion(self):
+        if self.conversion_thread and self.conversion_thread.isRunning():
+            return
+        header, jobs = self.journal.pending_jobs()
+        formats = header.get("formats") or [header["format"]] if header else []
+        if not jobs or header["type"] not in conversion_functions or any(fmt not in conversion_functions[header["type"]] for fmt in formats):
+            self.update_resume_button()
             return
+        settings = self.get_batch_settings()
+        settings.update(header.get("settings", {}))
+        settings["extra_formats"] = formats[1:]
+        self.status_text.setText("")
+        self.start_button.setVisible(True)
+        self.launch_conversion(jobs, header["type"], header["format"], settings, resume=True)
 
+    def launch_conversion(self, files_to_convert, conversion_type, selected_format, settings, resume=False):
         self.start_button.setEnabled(False)
         self.start_button.is_converting = True
         self.cancel_button.setVisible(True)
-        conversion_func = conversion_functions[self.conversion_type][self.selected_format]
-        
-        self.conversion_thread = ConversionThread(files_to_convert, self.conversion_type, self.selected_format, conversion_func, self.language)
+        self.resume_button.setVisible(False)
+        self.status_key = None
+        try:
+            max_workers = self.config.getint("Settings", "workers", fallback=0)
+        except Exception:
+            max_workers = 0
+        self.stream_report = None
+        self.conversion_thread = ConversionThread(
+            files_to_convert,
+            conversion_type,
+            selected_format,
+            self.language,
+            max_workers,
+            settings,
+            self.journal,
+            resume,
+            self.metrics,
+            self.result_cache,
+            self.conversion_queue,
+        )
+        self.conversion_thread.report_signal.connect(self.set_stream_report)
+        self.conversion_thread.scan_signal.connect(self.update_scan_progress)
         self.conversion_thread.progress_signal.connect(self.update_progress)
         self.conversion_thread.error_signal.connect(self.set_status_message)
         self.conversion_thread.completed_signal.connect(self.handle_completion)
@@ -1269,6 +1108,10 @@ class MorphWindow(QMainWindow):
         if self.taskbar_button and self.windowHandleCreated:
             self.taskbar_button.progress().setValue(int(value))
 
+    def update_scan_progress(self, found, queued):
+        if self.status_key in (None, "scan_progress"):
+            self.set_status_message("scan_progress", {"found": found, "queued": queued})
+
     def cancel_conversion(self):
         if self.conversion_thread and self.conversion_thread.isRunning():
             self.start_button.set_cancelled()
@@ -1280,25 +1123,22 @@ class MorphWindow(QMainWindow):
                     self.taskbar_button.progress().setVisible(False)
                 except Exception:
                     pass
-            terminate_ffmpeg_processes()
-            cleanup_temp_files()
 
     def handle_completion(self, failed_files, total_files):
         if self.conversion_thread.is_cancelled:
             self.start_button.set_cancelled()
-        elif failed_files == 0:
+        elif failed_files == 0 and total_files > 0:
             self.start_button.set_completed(success=True)
         else:
             self.start_button.set_completed(success=False)
         self.cancel_button.setVisible(False)
         if self.taskbar_button and self.windowHandleCreated:
             self.taskbar_button.progress().setVisible(False)
-        cleanup_temp_files()
-        terminate_ffmpeg_processes()
 
     def cleanup(self):
         self.conversion_thread = None
         self.start_button.is_converting = False
+        self.update_resume_button()
         if self.taskbar_button and self.windowHandleCreated:
             try:
                 self.taskbar_button.progress().setVisible(False)
@@ -1309,13 +1149,16 @@ class MorphWindow(QMainWindow):
         if self.conversion_thread and self.conversion_thread.isRunning():
             self.conversion_thread.stop()
             self.conversion_thread.wait()
+        if self.job_server:
+            self.job_server.stop()
+        self.conversion_queue.shutdown()
         if self.taskbar_button and self.windowHandleCreated:
             try:
                 self.taskbar_button.progress().setVisible(False)
             except Exception:
                 pass
+        self.thumbnail_loader.shutdown()
         terminate_ffmpeg_processes()
-        cleanup_temp_files(silent=True)
         try:
             if not self.config.has_section("Settings"):
                 self.config.add_section("Settings")
@@ -0,0 +1,280 @@
+"""
+Morph
+Copyright (C) 2025 Alexander Nemchinov
+https://linktr.ee/Nemchinov
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from morph_core import (
+    ffmpeg_path,
+    conversion_functions,
+    media_cache,
+    run_tool,
+    is_valid_file,
+)
+
+# Fixtures are rendered from ffmpeg's lavfi sources, so the same command
+# always produces the same file. Name -> (size, duration in seconds).
+video_fixture_sizes = {"small": ("640x360", 5), "hd": ("1920x1080", 20)}
+audio_fixture_durations = {"short": 10, "long": 120}
+image_fixture_sizes = {"small": "640x480", "large": "3840x2160"}
+quick_fixtures = ("small", "short")
+
+# Codecs each input container is usually found with.
+video_fixture_codecs = {
+    ".mp4": "-c:v libx264 -preset veryfast -c:a aac",
+    ".mkv": "-c:v libx264 -preset veryfast -c:a aac",
+    ".mov": "-c:v libx264 -preset veryfast -c:a aac",
+    ".avi": "-c:v mpeg4 -c:a ac3",
+    ".wmv": "-c:v wmv2 -c:a wmav2",
+    ".flv": "-c:v flv -c:a aac",
+    ".webm": "-c:v libvpx-vp9 -deadline realtime -cpu-used 8 -c:a libopus",
+    ".ts": "-c:v libx264 -preset veryfast -c:a aac -f mpegts",
+    ".m2ts": "-c:v libx264 -preset veryfast -c:a ac3 -f mpegts -mpegts_m2ts_mode 1",
+    ".mpeg": "-c:v mpeg2video -c:a mp2 -f mpeg",
+    ".mpg": "-c:v mpeg2video -c:a mp2 -f mpeg",
+    ".vob": "-c:v mpeg2video -c:a ac3 -f vob",
+}
+audio_fixture_codecs = {
+    ".mp3": "-c:a libmp3lame",
+    ".wav": "-c:a pcm_s16le",
+    ".m4a": "-c:a aac",
+    ".flac": "-c:a flac",
+    ".ogg": "-c:a libvorbis",
+    ".aac": "-c:a aac -f adts",
+    ".wma": "-c:a wmav2",
+    ".opus": "-c:a libopus",
+}
+# JXR, HEIC and DNG have no ffmpeg encoder and are not generated.
+image_fixture_codecs = {
+    ".png": "-c:v png",
+    ".jpg": "-c:v mjpeg -q:v 2",
+    ".bmp": "-c:v bmp",
+    ".gif": "-c:v gif",
+    ".tiff": "-c:v tiff",
+    ".webp": "-c:v libwebp",
+    ".avif": "-c:v libaom-av1 -still-picture 1",
+    ".ico": "-c:v png -pix_fmt rgba -f ico",
+}
+# Slowdowns smaller than this are timer noise, whatever the percentage.
+min_regression_seconds = 0.05
+bitexact_args = "-fflags +bitexact -flags:v +bitexact -flags:a +bitexact -map_metadata -1"
+
+def get_video_source(size, duration):
+    return [
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}", "-ac", "2",
+    ]
+
+def get_audio_source(duration):
+    return ["-f", "lavfi", "-i", f"sine=frequency=440:beep_factor=4:sample_rate=44100:duration={duration}", "-ac", "2"]
+
+def get_image_source(size):
+    return ["-f", "lavfi", "-i", f"mandelbrot=size={size}:end_pts=1", "-frames:v", "1"]
+
+def get_fixture_specs(quick=False):
+    """Yield (conversion type, file name, ffmpeg input args, codec args, units, unit)."""
+    for name, (size, duration) in video_fixture_sizes.items():
+        if quick and name not in quick_fixtures:
+            continue
+        for ext, codec_args in video_fixture_codecs.items():
+            yield "Video", f"video-{name}{ext}", get_video_source(size, duration), codec_args, duration, "x realtime"
+    for name, duration in audio_fixture_durations.items():
+        if quick and name not in quick_fixtures:
+            continue
+        for ext, codec_args in audio_fixture_codecs.items():
+            yield "Audio", f"audio-{name}{ext}", get_audio_source(duration), codec_args, duration, "x realtime"
+    for name, size in image_fixture_sizes.items():
+        if quick and name not in quick_fixtures:
+            continue
+        for ext, codec_args in image_fixture_codecs.items():
+            # ICO frames cannot be larger than 256x256.
+            image_size = "256x256" if ext == ".ico" else size
+            width, height = (int(value) for value in image_size.split("x"))
+            yield "Image", f"image-{name}{ext}", get_image_source(image_size), codec_args, width * height / 1000000, "MP/s"
+
+def generate_fixtures(fixtures_dir, quick=False):
+    """Render missing fixtures and return the ones available for benchmarking.
+
+    Encoders missing from the local ffmpeg build (e.g. libwebp) only skip
+    their fixtures.
+    """
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixtures = []
+    for conversion_type, name, source_args, codec_args, units, unit in get_fixture_specs(quick):
+        path = os.path.join(fixtures_dir, name)
+        if not os.path.exists(path):
+            temp_path = os.path.join(fixtures_dir, f"partial-{name}")
+            cmd = [ffmpeg_path, "-v", "error", "-y", *source_args, *codec_args.split(), *bitexact_args.split(), temp_path]
+            result = run_tool(cmd)
+            if result.returncode != 0 or not os.path.exists(temp_path):
+                print(f"skipped fixture {name}: {result.stderr.strip()}", file=sys.stderr)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                continue
+            os.replace(temp_path, path)
+        fixtures.append((conversion_type, path, units, unit))
+    return fixtures
+
+def measure(conversion_func, input_path, output_dir, extension):
+    output_path = os.path.join(output_dir, f"output.{extension.lower()}")
+    usage = {"cpu_seconds": 0.0, "peak_rss": 0}
+
+    def stats_callback(stats):
+        usage["cpu_seconds"] += stats.get("cpu_seconds", 0.0)
+        usage["peak_rss"] = max(usage["peak_rss"], stats.get("peak_rss", 0))
+
+    # Every run probes the input again, as a first conversion would.
+    media_cache.clear()
+    try:
+        start_time = time.monotonic()
+        result = conversion_func(input_path=input_path, output_path=output_path, progress_callback=lambda progress: None, stats_callback=stats_callback)
+        wall_time = time.monotonic() - start_time
+        if result.returncode != 0 or not os.path.exists(output_path):
+            message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "no output"
+            raise RuntimeError(message)
+        output_bytes = os.path.getsize(output_path)
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    return {"wall_time": wall_time, "output_bytes": output_bytes, **usage}
+
+def run_benchmarks(fixtures, repeat=3, only=None):
+    """Convert every fixture with every matching converter.
+
+    Each case runs ``repeat`` times and keeps the median wall and CPU time.
+    Throughput is media seconds per wall second for video and audio and
+    megapixels per second for images.
+    """
+    results = {}
+    output_dir = tempfile.mkdtemp(prefix="morph-bench-")
+    try:
+        for conversion_type, formats in conversion_functions.items():
+            for selected_format, conversion_func in formats.items():
+                if only and f"{conversion_type}/{selected_format}".lower() not in only:
+                    continue
+                for fixture_type, input_path, units, unit in fixtures:
+                    if fixture_type != conversion_type or not is_valid_file(input_path, conversion_type):
+                        continue
+                    key = f"{conversion_type}/{selected_format}/{os.path.basename(input_path)}"
+                    try:
+                        runs = [measure(conversion_func, input_path, output_dir, selected_format) for _ in range(repeat)]
+                    except Exception as e:
+                        results[key] = {"error": str(e)}
+                        print(f"{key}: failed: {e}", file=sys.stderr)
+                        continue
+                    wall_time = statistics.median(run["wall_time"] for run in runs)
+                    results[key] = {
+                        "wall_time": round(wall_time, 4),
+                        "cpu_seconds": round(statistics.median(run["cpu_seconds"] for run in runs), 4),
+                        "peak_rss": max(run["peak_rss"] for run in runs),
+                        "output_bytes": runs[-1]["output_bytes"],
+                        "input_bytes": os.path.getsize(input_path),
+                        "throughput": round(units / wall_time, 3) if wall_time > 0 else 0.0,
+                        "unit": unit,
+                    }
+                    print(f"{key}: {results[key]['throughput']} {unit}", file=sys.stderr)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+def get_environment():
+    try:
+        version = subprocess.run([ffmpeg_path, "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        version = ""
+    return {"ffmpeg": version, "platform": platform.platform(), "cpu_count": os.cpu_count(), "time": time.time()}
+
+def format_change(current, baseline):
+    if not baseline:
+        return ""
+    return f"{(current - baseline) / baseline * 100:+.1f}%"
+
+def compare_results(results, baseline, threshold):
+    """Print every case next to its baseline and return the regressed keys.
+
+    A case regresses when its wall or CPU time grew by more than
+    ``threshold`` percent and by more than ``min_regression_seconds``.
+    """
+    regressions = []
+    print(f"{'case':<48} {'throughput':>16} {'wall':>9} {'cpu':>9} {'size':>12} {'wall':>8} {'cpu':>8} {'size':>8}")
+    for key, result in sorted(results.items()):
+        if "error" in result:
+            print(f"{key:<48} failed: {result['error']}")
+            continue
+        old = baseline.get(key, {})
+        if "error" in old:
+            old = {}
+        print(
+            f"{key:<48} {result['throughput']:>9} {result['unit']:<6} {result['wall_time']:>8.3f}s {result['cpu_seconds']:>8.3f}s "
+            f"{result['output_bytes']:>12} {format_change(result['wall_time'], old.get('wall_time')):>8} "
+            f"{format_change(result['cpu_seconds'], old.get('cpu_seconds')):>8} {format_change(result['output_bytes'], old.get('output_bytes')):>8}"
+        )
+        for field in ("wall_time", "cpu_seconds"):
+            growth = result[field] - old.get(field, 0)
+            if old.get(field) and growth > min_regression_seconds and growth / old[field] * 100 > threshold:
+                regressions.append(key)
+                break
+    for key in sorted(set(baseline) - set(results)):
+        print(f"{key:<48} missing (in baseline only)")
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="morph_bench", description="Benchmark Morph converters on synthetic media")
+    parser.add_argument("--fixtures", metavar="DIR", default="bench_fixtures", help="where generated inputs are kept (default: bench_fixtures)")
+    parser.add_argument("--quick", action="store_true", help="only the smallest fixture of each kind")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median is reported (default: 3)")
+    parser.add_argument("--only", metavar="TYPE/FORMAT", action="append", help="limit to a converter, e.g. Video/MP4 (repeatable)")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent slowdown that counts as a regression (default: 10)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    fixtures = generate_fixtures(args.fixtures, args.quick)
+    only = {value.lower() for value in args.only} if args.only else None
+    results = run_benchmarks(fixtures, max(1, args.repeat), only)
+    if args.baseline and only:
+        baseline = {key: value for key, value in baseline.items() if "/".join(key.split("/")[:2]).lower() in only}
+    regressions = compare_results(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"environment": get_environment(), "results": results}, f, indent=2)
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:g}%: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
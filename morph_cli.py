@@ -0,0 +1,415 @@
+"""
+Morph
+Copyright (C) 2025 Alexander Nemchinov
+https://linktr.ee/Nemchinov
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import configparser
+
+from morph_core import (
+    conversion_functions,
+    parse_formats,
+    media_cache,
+    encoding_profiles,
+    load_profiles,
+    BatchJournal,
+    MetricsRecorder,
+    ResultCache,
+    BatchConverter,
+    ConversionJob,
+    parse_ico_sizes,
+)
+from morph_watch import FolderWatcher, iter_queue, default_settle_time
+from morph_server import ConversionQueue, JobServer, default_api_port
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_NO_FILES = 3
+EXIT_FAILED = 4
+EXIT_CANCELLED = 130
+
+priority_choices = ("normal", "low", "idle")
+
+def print_job(job, as_json):
+    if as_json:
+        print(json.dumps(job.to_dict(), ensure_ascii=False), flush=True)
+    else:
+        target = job.output_path if job.state == "done" else job.error or ""
+        print(f"{job.state}\t{job.input_path}\t{target}", flush=True)
+
+def command_formats(args):
+    for conversion_type, formats in conversion_functions.items():
+        print(f"{conversion_type}: {', '.join(formats)}")
+    load_profiles(args.profiles)
+    print(f"Profiles: {', '.join(encoding_profiles)}")
+    return EXIT_OK
+
+def get_metrics_recorder(args):
+    if not args.metrics_dir:
+        return None
+    return MetricsRecorder(args.metrics_dir, args.metrics_textfile)
+
+def get_result_cache(args):
+    if not args.cache_dir:
+        return None
+    return ResultCache(args.cache_dir, args.cache_size)
+
+def run_batch(args, files_to_convert, conversion_type, formats, settings, journal, resume=False):
+    converter = BatchConverter(
+        conversion_type,
+        formats[0],
+        args.jobs,
+        job_callback=lambda job: print_job(job, args.json),
+        journal=journal,
+        metrics=get_metrics_recorder(args),
+        result_cache=get_result_cache(args),
+        extra_formats=formats[1:],
+        **settings,
+    )
+    try:
+        jobs = converter.run(files_to_convert, resume)
+    except KeyboardInterrupt:
+        converter.stop()
+        return EXIT_CANCELLED
+    if not jobs and not converter.is_cancelled:
+        print("No valid files found", file=sys.stderr)
+        return EXIT_NO_FILES
+
+    report = converter.plan_report()
+    if report:
+        print(
+            f"remuxed: {report['remuxed']}, re-encoded: {report['encoded']}, "
+            f"streams copied: {report['copied']}, dropped: {report['dropped']}",
+            file=sys.stderr,
+        )
+
+    if converter.is_cancelled:
+        return EXIT_CANCELLED
+    if converter.failed_files == len(jobs):
+        return EXIT_FAILED
+    if converter.failed_files:
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+def command_convert(args):
+    try:
+        conversion_type, formats = parse_formats(args.to)
+        ico_sizes = parse_ico_sizes(args.ico_sizes) if args.ico_sizes else None
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.probe_cache:
+        media_cache.enable_persistence(args.probe_cache)
+    load_profiles(args.profiles)
+    if args.profile not in encoding_profiles:
+        print(f"Unknown profile: {args.profile} (available: {', '.join(encoding_profiles)})", file=sys.stderr)
+        return EXIT_USAGE
+
+    # Folders are walked by the converter while it already converts.
+    files_to_convert = [path for path in args.paths if os.path.exists(path)]
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    for path in missing:
+        job = ConversionJob(path, conversion_type, formats[0])
+        job.state, job.error = "failed", "file_access_error"
+        print_job(job, args.json)
+    if not files_to_convert:
+        print("No valid files found", file=sys.stderr)
+        return EXIT_NO_FILES
+
+    journal = BatchJournal(args.journal) if args.journal else None
+    settings = {
+        "remux": not args.no_remux,
+        "batch_size": args.batch_size,
+        "segment_parallel": args.segment_parallel,
+        "io_workers": args.io_jobs,
+        "scratch_dir": args.scratch_dir,
+        "scratch_quota_mb": args.scratch_quota,
+        "profile": args.profile,
+        "dedupe": not args.no_dedupe,
+        "full_hash": args.full_hash,
+        "priority": args.priority,
+        "io_priority": args.io_priority,
+        "pin_cores": args.pin_cores,
+        "fast_images": not args.no_fast_images,
+        "ico_sizes": ico_sizes,
+    }
+    result = run_batch(args, files_to_convert, conversion_type, formats, settings, journal)
+    if missing and result == EXIT_OK:
+        return EXIT_PARTIAL
+    return result
+
+def command_resume(args):
+    journal = BatchJournal(args.journal)
+    header, jobs = journal.pending_jobs()
+    if not jobs:
+        print("Nothing to resume", file=sys.stderr)
+        return EXIT_NO_FILES
+    conversion_type, formats = header["type"], header.get("formats") or [header["format"]]
+    for selected_format in formats:
+        if selected_format not in conversion_functions.get(conversion_type, {}):
+            print(f"Unknown format in journal: {selected_format}", file=sys.stderr)
+            return EXIT_USAGE
+    if args.probe_cache:
+        media_cache.enable_persistence(args.probe_cache)
+    load_profiles(args.profiles)
+    settings = dict(
+        header.get("settings", {}), io_workers=args.io_jobs, scratch_dir=args.scratch_dir, scratch_quota_mb=args.scratch_quota,
+        priority=args.priority, io_priority=args.io_priority, pin_cores=args.pin_cores,
+    )
+    return run_batch(args, jobs, conversion_type, formats, settings, journal, resume=True)
+
+def load_watch_rules(args):
+    """Return the folder rules of a watch, from --rules or from --to and the paths.
+
+    Each section of the rules file is a folder with its ``path`` and ``to``
+    formats, and optionally ``profile``, ``jobs`` and ``recursive``.
+    """
+    config = configparser.ConfigParser()
+    if args.rules:
+        try:
+            if not config.read(args.rules, encoding="utf-8"):
+                raise ValueError(f"Cannot read rules file: {args.rules}")
+        except configparser.Error as e:
+            raise ValueError(f"Invalid rules file: {e}")
+    elif args.to and args.paths:
+        config.read_dict({path: {"path": path, "to": args.to} for path in args.paths})
+    else:
+        raise ValueError("Give folders and --to, or a --rules file")
+    rules = []
+    for name in config.sections():
+        section = config[name]
+        if "path" not in section or "to" not in section:
+            raise ValueError(f"Rule {name} needs a path and a to")
+        if not os.path.isdir(section["path"]):
+            raise ValueError(f"Not a folder: {section['path']}")
+        conversion_type, formats = parse_formats(section["to"])
+        profile = section.get("profile", args.profile)
+        if profile not in encoding_profiles:
+            raise ValueError(f"Unknown profile: {profile} (available: {', '.join(encoding_profiles)})")
+        rules.append({
+            "name": name,
+            "path": section["path"],
+            "conversion_type": conversion_type,
+            "formats": formats,
+            "profile": profile,
+            "jobs": section.getint("jobs", args.jobs),
+            "recursive": section.getboolean("recursive", True),
+        })
+    return rules
+
+def command_watch(args):
+    load_profiles(args.profiles)
+    try:
+        rules = load_watch_rules(args)
+        ico_sizes = parse_ico_sizes(args.ico_sizes) if args.ico_sizes else None
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return EXIT_USAGE
+    if args.probe_cache:
+        media_cache.enable_persistence(args.probe_cache)
+
+    result_cache = get_result_cache(args)
+    settings = {
+        "remux": not args.no_remux,
+        "batch_size": args.batch_size,
+        "io_workers": args.io_jobs,
+        "dedupe": not args.no_dedupe,
+        "priority": args.priority,
+        "io_priority": args.io_priority,
+        "fast_images": not args.no_fast_images,
+        "ico_sizes": ico_sizes,
+    }
+    # One converter per folder rule, each fed by its own queue.
+    converters = []
+    for rule in rules:
+        converter = BatchConverter(
+            rule["conversion_type"],
+            rule["formats"][0],
+            rule["jobs"],
+            job_callback=lambda job: print_job(job, args.json),
+            result_cache=result_cache,
+            extra_formats=rule["formats"][1:],
+            profile=rule["profile"],
+            **settings,
+        )
+        rule["queue"] = queue.Queue()
+        thread = threading.Thread(target=converter.run, args=(iter_queue(rule["queue"]),), kwargs={"live": True}, daemon=True)
+        thread.start()
+        converters.append((converter, rule["queue"], thread))
+
+    watcher = FolderWatcher(
+        rules, lambda rule, path: rule["queue"].put(path),
+        settle_time=args.settle, existing=args.existing, use_inotify=not args.poll,
+    )
+    # Service managers stop daemons with SIGTERM; treat it like Ctrl+C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    for converter, pending, _ in converters:
+        converter.stop()
+        pending.put(None)
+    for _, _, thread in converters:
+        thread.join()
+    return EXIT_OK
+
+def command_serve(args):
+    load_profiles(args.profiles)
+    if args.profile not in encoding_profiles:
+        print(f"Unknown profile: {args.profile} (available: {', '.join(encoding_profiles)})", file=sys.stderr)
+        return EXIT_USAGE
+    if args.probe_cache:
+        media_cache.enable_persistence(args.probe_cache)
+
+    settings = {
+        "max_workers": args.jobs,
+        "io_workers": args.io_jobs,
+        "profile": args.profile,
+        "priority": args.priority,
+        "io_priority": args.io_priority,
+        "result_cache": get_result_cache(args),
+        "job_callback": lambda job: print_job(job, args.json),
+    }
+    conversion_queue = ConversionQueue()
+    server = JobServer(conversion_queue, lambda: settings, args.port, args.socket)
+    try:
+        server.start()
+    except OSError as e:
+        print(f"Cannot listen on {args.socket or args.port}: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    print(f"Listening on {server.address}", file=sys.stderr, flush=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    conversion_queue.shutdown()
+    return EXIT_OK
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="morph", description="Headless Morph converter")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="convert files and folders")
+    convert_parser.add_argument("--to", required=True, help="target format, e.g. mp4, webm, flac, jpg; several comma-separated ones (mp4,webm) are written from one decode of each file")
+    convert_parser.add_argument("--jobs", type=int, default=0, help="parallel workers (default: auto)")
+    convert_parser.add_argument("--io-jobs", type=int, default=0, help="parallel stream-copy jobs, on top of --jobs (default: 2)")
+    convert_parser.add_argument("--json", action="store_true", help="print one JSON object per file")
+    convert_parser.add_argument("--profile", default="archive", help="encoding tier: archive, balanced, fast or one from --profiles (default: archive)")
+    convert_parser.add_argument("--profiles", metavar="FILE", default="profiles.ini", help="INI file with extra or changed profiles (default: profiles.ini)")
+    convert_parser.add_argument("--priority", choices=priority_choices, default="normal", help="CPU priority of the encoders (default: normal)")
+    convert_parser.add_argument("--io-priority", choices=priority_choices, default="normal", help="disk priority of the encoders where the OS has one (default: normal)")
+    convert_parser.add_argument("--pin-cores", action="store_true", help="give each parallel encode its own set of cores")
+    convert_parser.add_argument("--no-remux", action="store_true", help="always re-encode instead of copying compatible streams")
+    convert_parser.add_argument("--batch-size", type=int, default=16, help="images per tool invocation where supported (1 disables batching)")
+    convert_parser.add_argument("--no-fast-images", action="store_true", help="always convert images with the external tools, not in-process with Pillow")
+    convert_parser.add_argument("--ico-sizes", metavar="SIZES", help="frame sizes of ICO outputs, e.g. 16,32,48,256 (default: 16,24,32,48,64,256)")
+    convert_parser.add_argument("--segment-parallel", action="store_true", help="split long videos and encode the pieces in parallel")
+    convert_parser.add_argument("--scratch-dir", metavar="DIR", help="encode into local DIR and move the finished file next to the source")
+    convert_parser.add_argument("--scratch-quota", metavar="MB", type=int, default=0, help="space the scratch dir may take (default: its free space)")
+    convert_parser.add_argument("--no-dedupe", action="store_true", help="convert identical copies of a file separately instead of once")
+    convert_parser.add_argument("--full-hash", action="store_true", help="compare whole files, not sampled blocks, to find identical copies")
+    convert_parser.add_argument("--cache-dir", metavar="DIR", help="keep outputs in DIR and reuse them for sources converted before")
+    convert_parser.add_argument("--cache-size", metavar="MB", type=int, default=2048, help="space the cache may take; least recently used outputs go first (default: 2048)")
+    convert_parser.add_argument("--probe-cache", metavar="FILE", help="keep ffprobe results in FILE between runs")
+    convert_parser.add_argument("--journal", metavar="FILE", help="record progress in FILE so the batch can be resumed")
+    convert_parser.add_argument("--metrics-dir", metavar="DIR", help="write per-job metrics of each batch as JSONL into DIR")
+    convert_parser.add_argument("--metrics-textfile", metavar="FILE", help="keep cumulative counters in FILE for node_exporter (needs --metrics-dir)")
+    convert_parser.add_argument("paths", nargs="+", help="files or folders to convert")
+    convert_parser.set_defaults(func=command_convert)
+
+    resume_parser = subparsers.add_parser("resume", help="continue an interrupted batch from its journal")
+    resume_parser.add_argument("--journal", metavar="FILE", required=True, help="journal written by 'convert --journal'")
+    resume_parser.add_argument("--jobs", type=int, default=0, help="parallel workers (default: auto)")
+    resume_parser.add_argument("--io-jobs", type=int, default=0, help="parallel stream-copy jobs, on top of --jobs (default: 2)")
+    resume_parser.add_argument("--json", action="store_true", help="print one JSON object per file")
+    resume_parser.add_argument("--priority", choices=priority_choices, default="normal", help="CPU priority of the encoders (default: normal)")
+    resume_parser.add_argument("--io-priority", choices=priority_choices, default="normal", help="disk priority of the encoders where the OS has one (default: normal)")
+    resume_parser.add_argument("--pin-cores", action="store_true", help="give each parallel encode its own set of cores")
+    resume_parser.add_argument("--scratch-dir", metavar="DIR", help="encode into local DIR and move the finished file next to the source")
+    resume_parser.add_argument("--scratch-quota", metavar="MB", type=int, default=0, help="space the scratch dir may take (default: its free space)")
+    resume_parser.add_argument("--profiles", metavar="FILE", default="profiles.ini", help="INI file with extra or changed profiles (default: profiles.ini)")
+    resume_parser.add_argument("--cache-dir", metavar="DIR", help="keep outputs in DIR and reuse them for sources converted before")
+    resume_parser.add_argument("--cache-size", metavar="MB", type=int, default=2048, help="space the cache may take; least recently used outputs go first (default: 2048)")
+    resume_parser.add_argument("--probe-cache", metavar="FILE", help="keep ffprobe results in FILE between runs")
+    resume_parser.add_argument("--metrics-dir", metavar="DIR", help="write per-job metrics of each batch as JSONL into DIR")
+    resume_parser.add_argument("--metrics-textfile", metavar="FILE", help="keep cumulative counters in FILE for node_exporter (needs --metrics-dir)")
+    resume_parser.set_defaults(func=command_resume)
+
+    watch_parser = subparsers.add_parser("watch", help="convert files as they arrive in watched folders")
+    watch_parser.add_argument("--rules", metavar="FILE", help="INI file with a section per folder: path, to, and optionally profile, jobs, recursive")
+    watch_parser.add_argument("--to", help="target format(s) of the folders given on the command line")
+    watch_parser.add_argument("--profile", default="archive", help="encoding tier of folders whose rule sets none (default: archive)")
+    watch_parser.add_argument("--profiles", metavar="FILE", default="profiles.ini", help="INI file with extra or changed profiles (default: profiles.ini)")
+    watch_parser.add_argument("--jobs", type=int, default=0, help="parallel workers per folder (default: auto)")
+    watch_parser.add_argument("--io-jobs", type=int, default=0, help="parallel stream-copy jobs per folder, on top of --jobs (default: 2)")
+    watch_parser.add_argument("--json", action="store_true", help="print one JSON object per file")
+    watch_parser.add_argument("--priority", choices=priority_choices, default="normal", help="CPU priority of the encoders (default: normal)")
+    watch_parser.add_argument("--io-priority", choices=priority_choices, default="normal", help="disk priority of the encoders where the OS has one (default: normal)")
+    watch_parser.add_argument("--settle", metavar="SECONDS", type=float, default=default_settle_time, help=f"convert a file nobody is seen closing once it is unchanged this long (default: {default_settle_time:g})")
+    watch_parser.add_argument("--existing", action="store_true", help="also convert the files already in the folders at start")
+    watch_parser.add_argument("--poll", action="store_true", help="poll the folders instead of using inotify")
+    watch_parser.add_argument("--no-remux", action="store_true", help="always re-encode instead of copying compatible streams")
+    watch_parser.add_argument("--batch-size", type=int, default=16, help="images per tool invocation where supported (1 disables batching)")
+    watch_parser.add_argument("--no-fast-images", action="store_true", help="always convert images with the external tools, not in-process with Pillow")
+    watch_parser.add_argument("--ico-sizes", metavar="SIZES", help="frame sizes of ICO outputs, e.g. 16,32,48,256 (default: 16,24,32,48,64,256)")
+    watch_parser.add_argument("--no-dedupe", action="store_true", help="convert identical copies of a file separately instead of once")
+    watch_parser.add_argument("--cache-dir", metavar="DIR", help="keep outputs in DIR and reuse them for sources converted before")
+    watch_parser.add_argument("--cache-size", metavar="MB", type=int, default=2048, help="space the cache may take; least recently used outputs go first (default: 2048)")
+    watch_parser.add_argument("--probe-cache", metavar="FILE", help="keep ffprobe results in FILE between runs")
+    watch_parser.add_argument("paths", nargs="*", help="folders to watch with --to")
+    watch_parser.set_defaults(func=command_watch)
+
+    serve_parser = subparsers.add_parser("serve", help="accept jobs from other programs over a local HTTP API")
+    serve_parser.add_argument("--port", type=int, default=default_api_port, help=f"port on 127.0.0.1 to listen on (default: {default_api_port})")
+    serve_parser.add_argument("--socket", metavar="PATH", help="listen on a Unix socket only the current user can open, instead of a port")
+    serve_parser.add_argument("--jobs", type=int, default=0, help="parallel workers (default: auto)")
+    serve_parser.add_argument("--io-jobs", type=int, default=0, help="parallel stream-copy jobs, on top of --jobs (default: 2)")
+    serve_parser.add_argument("--json", action="store_true", help="print one JSON object per file")
+    serve_parser.add_argument("--profile", default="archive", help="encoding tier of jobs that set none (default: archive)")
+    serve_parser.add_argument("--profiles", metavar="FILE", default="profiles.ini", help="INI file with extra or changed profiles (default: profiles.ini)")
+    serve_parser.add_argument("--priority", choices=priority_choices, default="normal", help="CPU priority of jobs that set none (default: normal)")
+    serve_parser.add_argument("--io-priority", choices=priority_choices, default="normal", help="disk priority of jobs that set none (default: normal)")
+    serve_parser.add_argument("--cache-dir", metavar="DIR", help="keep outputs in DIR and reuse them for sources converted before")
+    serve_parser.add_argument("--cache-size", metavar="MB", type=int, default=2048, help="space the cache may take; least recently used outputs go first (default: 2048)")
+    serve_parser.add_argument("--probe-cache", metavar="FILE", help="keep ffprobe results in FILE between runs")
+    serve_parser.set_defaults(func=command_serve)
+
+    formats_parser = subparsers.add_parser("formats", help="list supported target formats and encoding profiles")
+    formats_parser.add_argument("--profiles", metavar="FILE", default="profiles.ini", help="INI file with extra or changed profiles (default: profiles.ini)")
+    formats_parser.set_defaults(func=command_formats)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
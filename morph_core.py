@@ -0,0 +1,2636 @@
+"""
+Morph
+Copyright (C) 2025 Alexander Nemchinov
+https://linktr.ee/Nemchinov
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import sys
+import os
+import subprocess
+import time
+import atexit
+import threading
+import queue
+import hashlib
+import json
+import tempfile
+import re
+import shutil
+import errno
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, OrderedDict
+import psutil
+
+try:
+    from PIL import Image, ImageFilter, PngImagePlugin
+    pillow_available = True
+except ImportError:
+    pillow_available = False
+
+if pillow_available:
+    # Optional plugins that teach Pillow HEIC and (before Pillow 11.2) AVIF.
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+    except ImportError:
+        pass
+    try:
+        import pillow_avif
+    except ImportError:
+        pass
+
+ffmpeg_processes = set()
+
+def terminate_ffmpeg_processes():
+    for pid in list(ffmpeg_processes):
+        terminate_process_tree(pid)
+        ffmpeg_processes.discard(pid)
+
+atexit.register(terminate_ffmpeg_processes)
+
+def get_binary_path(binary_name):
+    """Return the path of a tool: the bundled bin folder first, then PATH.
+
+    On Windows the bundled file is ``<name>.exe``. A tool found in neither
+    place is returned by its bare name, so only the conversions that need
+    it fail, each with the launch error.
+    """
+    if getattr(sys, "frozen", False):
+        base_path = sys._MEIPASS
+    else:
+        base_path = os.path.dirname(os.path.abspath(__file__))
+    file_name = binary_name + ".exe" if sys.platform == "win32" else binary_name
+    path = os.path.join(base_path, "bin", file_name)
+    if os.path.exists(path):
+        return path
+    return shutil.which(binary_name) or binary_name
+
+ffmpeg_path = get_binary_path("ffmpeg")
+magick_path = get_binary_path("magick")
+exiftool_path = get_binary_path("exiftool")
+ffprobe_path = get_binary_path("ffprobe")
+
+# Keeps the tools' console windows hidden on Windows (CREATE_NO_WINDOW).
+creation_flags = 0x08000000 if sys.platform == "win32" else 0
+
+def start_process(args, **popen_args):
+    """Start a tool from its argument list, with no shell in between.
+
+    Arguments reach the tool as they are, so paths need no quoting, and
+    the returned process is the tool itself rather than a shell around it.
+    """
+    return subprocess.Popen(args, creationflags=creation_flags, **popen_args)
+
+video_extensions = [".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".ts", ".mpeg", ".vob", ".m2ts", ".bdav", ".mpg"]
+audio_extensions = [".mp3", ".wav", ".m4a", ".flac", ".ogg", ".aac", ".wma", ".opus"]
+image_extensions = [".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tiff", ".webp", ".jxr", ".heic", ".avif", ".ico", ".dng"]
+extension_types = {
+    ext: conversion_type
+    for conversion_type, extensions in (("Video", video_extensions), ("Audio", audio_extensions), ("Image", image_extensions))
+    for ext in extensions
+}
+
+class StreamInfo(namedtuple("StreamInfo", "index codec_type codec_name width height pix_fmt channels attached_pic")):
+    __slots__ = ()
+
+class MediaInfo(namedtuple("MediaInfo", "duration format_name streams")):
+    __slots__ = ()
+
+    def streams_of(self, codec_type):
+        return [stream for stream in self.streams if stream.codec_type == codec_type]
+
+    def codec_of(self, codec_type):
+        streams = self.streams_of(codec_type)
+        return streams[0].codec_name if streams else ""
+
+    def to_dict(self):
+        return {"duration": self.duration, "format_name": self.format_name, "streams": [list(stream) for stream in self.streams]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["duration"], data["format_name"], [StreamInfo(*stream) for stream in data["streams"]])
+
+def parse_probe_output(output):
+    data = json.loads(output or "{}")
+    fmt = data.get("format", {})
+    try:
+        duration = float(fmt.get("duration", 0))
+    except ValueError:
+        duration = 0.0
+    streams = [
+        StreamInfo(
+            stream.get("index", 0),
+            stream.get("codec_type", ""),
+            stream.get("codec_name", ""),
+            stream.get("width", 0),
+            stream.get("height", 0),
+            stream.get("pix_fmt", ""),
+            stream.get("channels", 0),
+            bool(stream.get("disposition", {}).get("attached_pic", 0)),
+        )
+        for stream in data.get("streams", [])
+    ]
+    return MediaInfo(duration, fmt.get("format_name", ""), streams)
+
+class MediaInfoCache:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.cache_file = None
+        self.dirty = False
+
+    def enable_persistence(self, cache_file):
+        self.cache_file = cache_file
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with self.lock:
+                for key, data in stored.items():
+                    self.entries[key] = MediaInfo.from_dict(data)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        if not self.cache_file or not self.dirty:
+            return
+        with self.lock:
+            stored = {key: info.to_dict() for key, info in self.entries.items()}
+            self.dirty = False
+        try:
+            temp_path = f"{self.cache_file}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(stored, f)
+            os.replace(temp_path, self.cache_file)
+        except OSError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            info = self.entries.get(key)
+            if info is not None:
+                self.entries.move_to_end(key)
+            return info
+
+    def put(self, key, info):
+        with self.lock:
+            self.entries[key] = info
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+media_cache = MediaInfoCache()
+atexit.register(media_cache.save)
+
+def get_media_cache_key(input_path):
+    stat = os.stat(input_path)
+    return f"{os.path.abspath(input_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def probe_media(input_path):
+    try:
+        key = get_media_cache_key(input_path)
+    except OSError:
+        return None
+    info = media_cache.get(key)
+    if info is not None:
+        return info
+    cmd = [ffprobe_path, "-v", "error", "-show_format", "-show_streams", "-of", "json", input_path]
+    try:
+        process = start_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        ffmpeg_processes.add(process.pid)
+        output = process.communicate()[0].decode("utf-8", errors="replace")
+        ffmpeg_processes.discard(process.pid)
+        if process.returncode != 0:
+            return None
+        info = parse_probe_output(output)
+    except (OSError, ValueError):
+        return None
+    media_cache.put(key, info)
+    return info
+
+def get_duration(input_path):
+    info = probe_media(input_path)
+    return info.duration if info else 0.0
+
+def get_audio_codec(input_path):
+    info = probe_media(input_path)
+    return info.codec_of("audio") if info else ""
+
+thumbnail_cache_dir = "thumbnail_cache"
+thumbnail_size = 64
+thumbnail_seek_time = 5
+# Disk space the thumbnail cache may take; the least recently shown
+# thumbnails are removed past it. An entry takes at least one disk block.
+thumbnail_cache_limit = 64 * 1024 * 1024
+thumbnail_block_size = 4096
+thumbnail_cache_lock = threading.Lock()
+thumbnail_cache_used = None
+
+def get_thumbnail_cache_path(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(thumbnail_cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+
+def run_thumbnail_command(cmd):
+    try:
+        process = start_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    stdout = process.communicate()[0]
+    if process.returncode == 0:
+        return stdout
+    return None
+
+def generate_thumbnail_data(file_path):
+    """Return PNG data, b"" for a file without a picture, or None on failure."""
+    ext = os.path.splitext(file_path)[1].lower()
+    scale = f"scale={thumbnail_size}:{thumbnail_size}"
+    if ext in video_extensions:
+        # Seek on the demuxer and decode keyframes only. The probe result is
+        # cached, so the conversion of this file later reuses it.
+        duration = get_duration(file_path)
+        seek = min(thumbnail_seek_time, duration / 2)
+        return run_thumbnail_command(
+            [ffmpeg_path, "-v", "error", "-skip_frame", "nokey", "-ss", f"{seek:.3f}", "-i", file_path, "-vf", scale, "-frames:v", "1", "-f", "image2pipe", "-c:v", "png", "-"]
+        )
+    if ext in image_extensions:
+        return run_thumbnail_command(
+            [ffmpeg_path, "-v", "error", "-i", file_path, "-vf", scale, "-frames:v", "1", "-f", "image2pipe", "-c:v", "png", "-"]
+        )
+    if ext in audio_extensions:
+        info = probe_media(file_path)
+        if info is None:
+            return None
+        if not info.streams_of("video"):
+            return b""
+        return run_thumbnail_command(
+            [ffmpeg_path, "-v", "error", "-i", file_path, "-an", "-c:v", "copy", "-frames:v", "1", "-f", "image2pipe", "-"]
+        )
+    return b""
+
+def trim_thumbnail_cache(added):
+    """Count ``added`` bytes into the cache; past the limit, remove the
+    least recently used entries."""
+    global thumbnail_cache_used
+    with thumbnail_cache_lock:
+        if thumbnail_cache_used is not None:
+            thumbnail_cache_used += added
+            if thumbnail_cache_used <= thumbnail_cache_limit:
+                return
+        entries = []
+        try:
+            with os.scandir(thumbnail_cache_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith(".png"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, max(stat.st_size, thumbnail_block_size), entry.path))
+        except OSError:
+            return
+        used = sum(size for _, size, _ in entries)
+        # Trim below the limit, so the next few entries do not list it again.
+        target = thumbnail_cache_limit * 0.9 if used > thumbnail_cache_limit else used
+        for _, size, path in sorted(entries):
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+        thumbnail_cache_used = used
+
+def get_thumbnail(file_path):
+    cache_path = get_thumbnail_cache_path(file_path)
+    if cache_path is None:
+        return None
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        data = None
+    if data is not None:
+        # The entry's mtime is its last use, for the eviction.
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return data or None
+    data = generate_thumbnail_data(file_path)
+    if data is None:
+        # ffmpeg failed, maybe only for now (file still being copied,
+        # locked, out of memory): try again next time.
+        return None
+    try:
+        os.makedirs(thumbnail_cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            # An empty entry remembers files without a picture (e.g. audio
+            # without cover art) so they are not probed again.
+            f.write(data)
+        os.replace(temp_path, cache_path)
+        trim_thumbnail_cache(max(len(data), thumbnail_block_size))
+    except OSError:
+        pass
+    return data or None
+
+# Minimum seconds between two progress reports from one running tool.
+progress_interval = 0.25
+
+def terminate_process_tree(pid):
+    try:
+        process = psutil.Process(pid)
+        for child in process.children(recursive=True):
+            try:
+                child.terminate()
+                child.wait(1)
+            except psutil.TimeoutExpired:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        process.terminate()
+        process.wait(1)
+    except psutil.TimeoutExpired:
+        process.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+# CPU and disk priority of spawned tools per setting: (nice value on POSIX,
+# priority class on Windows, I/O priority). "normal" leaves a process as it
+# was started.
+if sys.platform == "win32":
+    priority_levels = {
+        "low": (psutil.BELOW_NORMAL_PRIORITY_CLASS, psutil.IOPRIO_LOW),
+        "idle": (psutil.IDLE_PRIORITY_CLASS, psutil.IOPRIO_VERYLOW),
+    }
+elif hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+    priority_levels = {
+        "low": (10, (psutil.IOPRIO_CLASS_BE, 7)),
+        "idle": (19, (psutil.IOPRIO_CLASS_IDLE, 0)),
+    }
+else:
+    # No I/O priorities outside Linux and Windows.
+    priority_levels = {"low": (10, None), "idle": (19, None)}
+
+def apply_process_limits(pid, priority="normal", io_priority="normal", cores=None):
+    """Set CPU priority, I/O priority and core affinity of a tool and its children.
+
+    Children started later inherit all three on Linux; on Windows they
+    inherit the priority class. Failures are ignored, the tool then just
+    keeps running with the defaults.
+    """
+    if priority == "normal" and io_priority == "normal" and not cores:
+        return
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return
+    for handle in processes:
+        try:
+            if priority in priority_levels:
+                handle.nice(priority_levels[priority][0])
+            if io_priority in priority_levels and priority_levels[io_priority][1] is not None:
+                io_level = priority_levels[io_priority][1]
+                if isinstance(io_level, tuple):
+                    handle.ionice(*io_level)
+                else:
+                    handle.ionice(io_level)
+            if cores and hasattr(handle, "cpu_affinity"):
+                handle.cpu_affinity(cores)
+        except (psutil.Error, OSError, ValueError):
+            pass
+
+def get_worker_cores(slot, count):
+    """Return the cores of worker ``slot`` out of ``count``: an even, contiguous share.
+
+    Neighbouring cores usually share caches, so the threads of one encode
+    stay close together and parallel encodes don't compete for the same
+    cores.
+    """
+    try:
+        available = sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        available = list(range(os.cpu_count() or 1))
+    cores = available[slot * len(available) // count:(slot + 1) * len(available) // count]
+    # With more workers than cores, neighbouring slots share one.
+    return cores or [available[slot * len(available) // count]]
+
+def parse_progress_block(block, duration):
+    stats = {"out_time": 0.0, "fps": 0.0, "speed": 0.0, "total_size": 0, "percent": 0.0}
+    try:
+        out_time = block.get("out_time_us") or block.get("out_time_ms")
+        if out_time and out_time != "N/A":
+            stats["out_time"] = max(int(out_time), 0) / 1000000
+        stats["fps"] = float(block.get("fps", 0) or 0)
+        speed = block.get("speed", "0").rstrip("x").strip()
+        stats["speed"] = float(speed) if speed and speed != "N/A" else 0.0
+        total_size = block.get("total_size", "0")
+        stats["total_size"] = int(total_size) if total_size.isdigit() else 0
+    except ValueError:
+        pass
+    if duration > 0:
+        stats["percent"] = min(stats["out_time"] / duration * 100, 100)
+    if block.get("progress") == "end":
+        stats["percent"] = 100.0
+    return stats
+
+def wait_process(process):
+    """Wait for a tool to exit and return the CPU time and peak RSS it used.
+
+    On POSIX wait4() reports both for the process and every descendant it
+    reaped (e.g. the delegates ImageMagick runs). On Windows the exited process is
+    still readable through its handle, which Popen keeps open until the
+    object goes away.
+    """
+    if hasattr(os, "wait4"):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            process.wait()
+            return {}
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        return {"cpu_seconds": usage.ru_utime + usage.ru_stime, "peak_rss": peak_rss}
+    process.wait()
+    try:
+        handle = psutil.Process(process.pid)
+        cpu = handle.cpu_times()
+        return {"cpu_seconds": cpu.user + cpu.system, "peak_rss": getattr(handle.memory_info(), "peak_wset", 0)}
+    except psutil.Error:
+        return {}
+
+def run_tool(cmd, progress_callback=None, duration=0.0, stats_callback=None, process_callback=None, **options):
+    """Run one external tool and wait for it on its output pipe.
+
+    Tools started with ``-progress pipe:1`` report key=value blocks on stdout;
+    each block is parsed and reported at most every ``progress_interval``
+    seconds. stderr goes to a temporary file so a chatty tool can never block
+    on a full pipe, and its tail is returned for error reporting.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            process = start_process(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=stderr_file, text=True, encoding="utf-8", errors="replace"
+            )
+        except Exception as e:
+            return subprocess.CompletedProcess(args=cmd, returncode=1, stdout="", stderr=str(e))
+        ffmpeg_processes.add(process.pid)
+        if process_callback:
+            process_callback(process)
+        try:
+            block = {}
+            last_report = 0.0
+            for line in process.stdout:
+                key, separator, value = line.strip().partition("=")
+                if not separator:
+                    continue
+                block[key] = value
+                if key != "progress":
+                    continue
+                now = time.monotonic()
+                if value == "end" or now - last_report >= progress_interval:
+                    last_report = now
+                    stats = parse_progress_block(block, duration)
+                    if stats_callback:
+                        stats_callback(stats)
+                    if progress_callback and duration > 0:
+                        progress_callback(stats["percent"])
+                block = {}
+            usage = wait_process(process)
+            if stats_callback and usage:
+                stats_callback(usage)
+        finally:
+            process.stdout.close()
+            ffmpeg_processes.discard(process.pid)
+        stderr_file.seek(0)
+        stderr = stderr_file.read()[-4000:].decode("utf-8", errors="replace")
+    return subprocess.CompletedProcess(args=cmd, returncode=process.returncode, stdout="", stderr=stderr)
+
+# Codecs each target container can carry as-is; anything else is encoded
+# (or dropped, for subtitles the container cannot hold at all).
+container_copy_codecs = {
+    "MP4": {
+        "video": {"h264", "hevc", "mpeg4", "av1"},
+        "audio": {"aac", "alac", "mp3", "ac3", "eac3"},
+        "subtitle": {"mov_text"},
+    },
+    "WebM": {
+        "video": {"vp8", "vp9", "av1"},
+        "audio": {"opus", "vorbis"},
+        "subtitle": {"webvtt"},
+    },
+}
+container_subtitle_encoders = {"MP4": "mov_text", "WebM": "webvtt"}
+text_subtitle_codecs = {"subrip", "ass", "ssa", "webvtt", "mov_text", "text"}
+
+def plan_streams(info, target, remux=True):
+    """Return (stream, action, codec) for every source stream.
+
+    action is "copy", "encode" or "drop". With remux enabled, video and audio
+    the target container already supports are copied instead of re-encoded.
+    """
+    copy_codecs = container_copy_codecs[target]
+    plan = []
+    video_streams = [stream for stream in info.streams_of("video") if not stream.attached_pic]
+    if target == "MP4":
+        video_streams = video_streams[:1]
+    for stream in video_streams:
+        action = "copy" if remux and stream.codec_name in copy_codecs["video"] else "encode"
+        plan.append((stream, action, stream.codec_name))
+    for stream in info.streams_of("audio"):
+        action = "copy" if remux and stream.codec_name in copy_codecs["audio"] else "encode"
+        plan.append((stream, action, stream.codec_name))
+    for stream in info.streams_of("subtitle"):
+        if stream.codec_name in copy_codecs["subtitle"]:
+            plan.append((stream, "copy", stream.codec_name))
+        elif stream.codec_name in text_subtitle_codecs:
+            plan.append((stream, "encode", container_subtitle_encoders[target]))
+        else:
+            plan.append((stream, "drop", stream.codec_name))
+    return plan
+
+def summarize_plan(plan):
+    summary = {"copied": 0, "encoded": 0, "dropped": 0}
+    for _, action, _ in plan:
+        summary[{"copy": "copied", "encode": "encoded", "drop": "dropped"}[action]] += 1
+    return summary
+
+def format_encoder_args(template, specifier):
+    # Templates hold options only, never paths, so splitting on spaces is safe.
+    return template.format(s=specifier).split()
+
+def build_stream_args(plan, encoder_args, input_index=0):
+    args = []
+    output_index = {"video": 0, "audio": 0, "subtitle": 0}
+    for stream, action, codec in plan:
+        if action == "drop":
+            continue
+        kind = stream.codec_type
+        specifier = f"{kind[0]}:{output_index[kind]}"
+        output_index[kind] += 1
+        args += ["-map", f"{input_index}:{stream.index}"]
+        if action == "copy":
+            args += [f"-c:{specifier}", "copy"]
+        elif kind == "subtitle":
+            args += [f"-c:{specifier}", codec]
+        else:
+            args += format_encoder_args(encoder_args[kind], specifier)
+    return args
+
+# Encoding tiers. "archive" is what Morph has always used; the others give
+# up quality for speed. An empty value leaves the option out, "auto" threads
+# split the cores between the parallel encodes.
+builtin_profiles = {
+    "archive": {
+        "x264_preset": "medium", "x264_crf": "18", "x264_profile": "high444", "x264_pix_fmt": "yuv444p", "x264_threads": "",
+        "vp9_crf": "18", "vp9_deadline": "good", "vp9_cpu_used": "", "vp9_row_mt": "", "vp9_tile_columns": "", "vp9_threads": "4",
+        "aac_bitrate": "320k", "opus_bitrate": "320k",
+    },
+    "balanced": {
+        "x264_preset": "fast", "x264_crf": "20", "x264_profile": "high", "x264_pix_fmt": "yuv420p", "x264_threads": "auto",
+        "vp9_crf": "31", "vp9_deadline": "good", "vp9_cpu_used": "2", "vp9_row_mt": "1", "vp9_tile_columns": "2", "vp9_threads": "auto",
+        "aac_bitrate": "192k", "opus_bitrate": "160k",
+    },
+    "fast": {
+        "x264_preset": "veryfast", "x264_crf": "23", "x264_profile": "high", "x264_pix_fmt": "yuv420p", "x264_threads": "auto",
+        "vp9_crf": "33", "vp9_deadline": "realtime", "vp9_cpu_used": "6", "vp9_row_mt": "1", "vp9_tile_columns": "2", "vp9_threads": "auto",
+        "aac_bitrate": "160k", "opus_bitrate": "128k",
+    },
+}
+default_profile = "archive"
+encoding_profiles = {name: dict(settings) for name, settings in builtin_profiles.items()}
+
+def load_profiles(profiles_file):
+    """Add the profiles of an INI file to ``encoding_profiles``.
+
+    Each section is a profile. It starts from the built-in profile of the
+    same name, or from the one named by its ``base`` key (default
+    "archive"), and overrides the keys it sets.
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(profiles_file, encoding="utf-8")
+    except configparser.Error:
+        return encoding_profiles
+    for name in config.sections():
+        section = dict(config[name])
+        base = section.pop("base", name if name in encoding_profiles else default_profile)
+        profile = dict(encoding_profiles.get(base, builtin_profiles[default_profile]))
+        profile.update((key, value) for key, value in section.items() if key in profile)
+        encoding_profiles[name] = profile
+    return encoding_profiles
+
+def get_encoder_args(target, profile=None, thread_budget=0, fixed_threads=False):
+    """Return the video and audio encoder templates of a profile.
+
+    ``thread_budget`` is how many cores one encode may use; "auto" thread
+    settings fall back to the share the default worker count leaves. With
+    ``fixed_threads`` the encoder gets exactly ``thread_budget`` threads,
+    whatever the profile sets.
+    """
+    settings = encoding_profiles.get(profile or default_profile, encoding_profiles[default_profile])
+
+    def option(name, value):
+        if name == "threads" and fixed_threads:
+            value = str(thread_budget)
+        elif value == "auto":
+            value = str(thread_budget or max(1, (os.cpu_count() or 1) // get_worker_count(target)))
+        return f" -{name}:{{s}} {value}" if value else ""
+
+    if target == "MP4":
+        video = (
+            "-c:{s} libx264" + option("profile", settings["x264_profile"]) + option("pix_fmt", settings["x264_pix_fmt"])
+            + option("crf", settings["x264_crf"]) + option("preset", settings["x264_preset"]) + option("threads", settings["x264_threads"])
+        )
+        audio = "-c:{s} aac" + option("b", settings["aac_bitrate"])
+    else:
+        video = (
+            "-c:{s} libvpx-vp9" + option("crf", settings["vp9_crf"]) + " -b:{s} 0" + option("deadline", settings["vp9_deadline"])
+            + option("cpu-used", settings["vp9_cpu_used"]) + option("row-mt", settings["vp9_row_mt"])
+            + option("tile-columns", settings["vp9_tile_columns"]) + " -auto-alt-ref:{s} 0" + option("threads", settings["vp9_threads"])
+        )
+        audio = "-c:{s} libopus" + option("b", settings["opus_bitrate"])
+    return {"video": video, "audio": audio}
+
+def report_plan(plan, options):
+    plan_callback = options.get("plan_callback")
+    if plan_callback:
+        plan_callback(summarize_plan(plan))
+
+# Files at least this long (seconds) are split and encoded in parallel when
+# segment-parallel encoding is enabled.
+segment_min_duration = 600
+
+def should_encode_segmented(info, plan, segment_parallel):
+    video = [(stream, action) for stream, action, _ in plan if stream.codec_type == "video"]
+    return segment_parallel and info.duration >= segment_min_duration and len(video) == 1 and video[0][1] == "encode"
+
+def encode_video_segmented(input_path, output_path, progress_callback, info, plan, encoder_args, output_args, segment_count, **options):
+    """Split the video at keyframes, encode the pieces in parallel, then join.
+
+    The video stream is cut with the segment muxer (stream copy, so cuts land
+    on keyframes), every piece is encoded by its own ffmpeg with the same
+    settings, and the encoded pieces are concatenated losslessly while audio,
+    subtitles and metadata are taken from the original file.
+    """
+    video_stream = next(stream for stream, _, _ in plan if stream.codec_type == "video")
+    other_streams = [entry for entry in plan if entry[0].codec_type != "video"]
+    work_dir = tempfile.mkdtemp(prefix="morph_segments_")
+    try:
+        segment_time = max(info.duration / segment_count, 1)
+        split_cmd = [
+            ffmpeg_path, "-i", input_path, "-map", f"0:{video_stream.index}", "-c", "copy", "-f", "segment",
+            "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1", os.path.join(work_dir, "source_%05d.mkv"),
+        ]
+        result = run_tool(split_cmd, **options)
+        if result.returncode != 0:
+            return result
+        progress_callback(5)
+
+        sources = sorted(os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith("source_"))
+        durations = [get_duration(source) or segment_time for source in sources]
+        total_duration = sum(durations)
+        done = [0.0] * len(sources)
+        lock = threading.Lock()
+
+        def encode_segment(index):
+            def segment_progress(progress):
+                with lock:
+                    done[index] = durations[index] * progress / 100
+                    overall = sum(done) / total_duration
+                progress_callback(5 + overall * 85)
+
+            encoded = os.path.join(work_dir, f"encoded_{index:05d}.mkv")
+            cmd = [ffmpeg_path, "-i", sources[index], "-map", "0:v:0", *format_encoder_args(encoder_args["video"], "v:0"), "-progress", "pipe:1", encoded]
+            return run_tool(cmd, segment_progress, durations[index], **options)
+
+        with ThreadPoolExecutor(max_workers=segment_count) as executor:
+            results = list(executor.map(encode_segment, range(len(sources))))
+        for result in results:
+            if result.returncode != 0:
+                return result
+
+        list_path = os.path.join(work_dir, "segments.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for index in range(len(sources)):
+                encoded = os.path.join(work_dir, f"encoded_{index:05d}.mkv").replace("\\", "/")
+                f.write(f"file '{encoded}'\n")
+        stream_args = ["-map", "0:v:0", "-c:v:0", "copy"] + build_stream_args(other_streams, encoder_args, input_index=1)
+        concat_cmd = [
+            ffmpeg_path, "-f", "concat", "-safe", "0", "-i", list_path, "-i", input_path,
+            *stream_args, *output_args, "-map_metadata", "1", "-progress", "pipe:1", output_path,
+        ]
+        return run_tool(concat_cmd, lambda progress: progress_callback(90 + progress / 10), info.duration, **options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Output options every video target ends with, after the stream mapping.
+video_output_args = {
+    "MP4": ["-map", "0:t?", "-map", "-0:d", "-c:t", "copy", "-map_metadata", "0", "-fflags", "+genpts", "-movflags", "+faststart"],
+    "MKV": ["-map", "0", "-map", "-0:d", "-c:v", "copy", "-c:a", "copy", "-c:s", "copy", "-c:t", "copy", "-map_metadata", "0", "-fflags", "+genpts"],
+    "WebM": ["-map_metadata", "0", "-fflags", "+genpts"],
+}
+
+def get_video_output_args(target, info, remux=True, profile=None, thread_budget=0, **options):
+    """Return the ffmpeg output options that make ``target`` from a probed file."""
+    if target == "MKV":
+        return video_output_args["MKV"]
+    encoder_args = get_encoder_args(target, profile, thread_budget)
+    if info is None or not info.streams_of("video"):
+        video_map = "0:v:0?" if target == "MP4" else "0:v?"
+        stream_args = [
+            "-map", video_map, "-map", "0:a?", "-map", "0:s?",
+            *format_encoder_args(encoder_args["video"], "v"), *format_encoder_args(encoder_args["audio"], "a"), "-c:s", "copy",
+        ]
+    else:
+        plan = plan_streams(info, target, remux)
+        report_plan(plan, options)
+        stream_args = build_stream_args(plan, encoder_args)
+    return stream_args + video_output_args[target]
+
+def encode_video_target(target, input_path, output_path, progress_callback, remux, segment_parallel, segment_count, profile, thread_budget, segment_budget=0, **options):
+    info = probe_media(input_path)
+    # The pieces share the threads the job may split (its pinned cores, if
+    # any), so the jobs running side by side never oversubscribe the CPU.
+    job_threads = segment_budget or thread_budget or os.cpu_count() or 1
+    segment_count = segment_count or job_threads // encoder_threads.get(target, 1)
+    if segment_parallel and segment_count > 1 and info is not None and info.streams_of("video"):
+        plan = plan_streams(info, target, remux)
+        if should_encode_segmented(info, plan, segment_parallel):
+            report_plan(plan, options)
+            output_args = ["-map", "1:t?", "-map", "-1:d", "-c:t", "copy", "-movflags", "+faststart"] if target == "MP4" else []
+            return encode_video_segmented(
+                input_path, output_path, progress_callback, info, plan,
+                get_encoder_args(target, profile, max(1, job_threads // segment_count), fixed_threads=True),
+                output_args, segment_count, **options
+            )
+    output_args = get_video_output_args(target, info, remux, profile, thread_budget, **options)
+    cmd = [ffmpeg_path, "-i", input_path, *output_args, "-progress", "pipe:1", output_path]
+    return run_tool(cmd, progress_callback, info.duration if info else 0.0, **options)
+
+def convert_video_to_mp4(input_path, output_path, progress_callback, remux=True, segment_parallel=False, segment_count=0, profile=None, thread_budget=0, **options):
+    return encode_video_target("MP4", input_path, output_path, progress_callback, remux, segment_parallel, segment_count, profile, thread_budget, **options)
+
+def convert_video_to_mkv(input_path, output_path, progress_callback, **options):
+    duration = get_duration(input_path)
+    cmd = [ffmpeg_path, "-i", input_path, *video_output_args["MKV"], "-progress", "pipe:1", output_path]
+    return run_tool(cmd, progress_callback, duration, **options)
+
+def convert_video_to_webm(input_path, output_path, progress_callback, remux=True, segment_parallel=False, segment_count=0, profile=None, thread_budget=0, **options):
+    return encode_video_target("WebM", input_path, output_path, progress_callback, remux, segment_parallel, segment_count, profile, thread_budget, **options)
+
+# Source audio codecs each audio target keeps as they are, and the encoder
+# for everything else.
+audio_copy_codecs = {"M4A": ["aac", "alac"], "FLAC": ["flac"]}
+audio_encoders = {"M4A": "alac", "FLAC": "flac"}
+
+def get_audio_output_args(target, info):
+    codec = info.codec_of("audio") if info else ""
+    if codec in audio_copy_codecs[target]:
+        return ["-map", "0", "-c", "copy", "-map_metadata", "0"]
+    return ["-map", "0", "-c:a", audio_encoders[target], "-c:v", "copy", "-map_metadata", "0"]
+
+def convert_audio_to_m4a(input_path, output_path, progress_callback, **options):
+    info = probe_media(input_path)
+    cmd = [ffmpeg_path, "-i", input_path, *get_audio_output_args("M4A", info), "-progress", "pipe:1", output_path]
+    return run_tool(cmd, progress_callback, info.duration if info else 0.0, **options)
+
+def convert_audio_to_flac(input_path, output_path, progress_callback, **options):
+    info = probe_media(input_path)
+    cmd = [ffmpeg_path, "-i", input_path, *get_audio_output_args("FLAC", info), "-progress", "pipe:1", output_path]
+    return run_tool(cmd, progress_callback, info.duration if info else 0.0, **options)
+
+def convert_to_formats(input_path, outputs, progress_callback, conversion_type, remux=True, profile=None, thread_budget=0, **options):
+    """Write several formats of one video or audio file in a single ffmpeg run.
+
+    ``outputs`` holds (format, output path, plan callback) entries. The input
+    is read and decoded once and feeds the encoders and muxers of every
+    output, which therefore advance together and share the run's progress.
+    Returns one CompletedProcess per output.
+    """
+    info = probe_media(input_path)
+    cmd = [ffmpeg_path, "-i", input_path, "-progress", "pipe:1"]
+    for selected_format, output_path, plan_callback in outputs:
+        if conversion_type == "Video":
+            cmd += get_video_output_args(selected_format, info, remux, profile, thread_budget, plan_callback=plan_callback)
+        else:
+            cmd += get_audio_output_args(selected_format, info)
+        cmd.append(output_path)
+    result = run_tool(cmd, progress_callback, info.duration if info else 0.0, **options)
+    # ffmpeg fails the whole run when any output fails; an output that was
+    # not written at all is reported as failed on its own.
+    return [
+        subprocess.CompletedProcess(
+            args=cmd, returncode=result.returncode or int(get_file_size(output_path) == 0),
+            stdout="", stderr=result.stderr,
+        )
+        for _, output_path, _ in outputs
+    ]
+
+# The density is read into a per-image variable before -strip and written
+# back after it, so it survives without a separate "magick identify" pass.
+jpg_magick_args = ["-set", "option:morph:density", "%xx%y", "-strip", "-set", "density", "%[morph:density]", "-quality", "95"]
+
+# Share of the memory available when a job starts that ImageMagick jobs may
+# use together; beyond its limits the pixel cache goes to disk instead of
+# pushing the machine into swap.
+magick_memory_share = 0.5
+# Images with more pixels than this are converted one at a time with their
+# pixel cache mostly on disk. Files smaller than large_image_min_bytes are
+# not looked at. The size comes from the file header through Pillow, which
+# reads no pixels, else from ffprobe; files neither can read count as large
+# from large_image_fallback_bytes.
+large_image_pixels = 50 * 1000 * 1000
+large_image_min_bytes = 4 * 1024 * 1024
+large_image_fallback_bytes = 64 * 1024 * 1024
+large_image_slots = threading.Semaphore(1)
+
+def get_memory_budget(workers):
+    try:
+        available = psutil.virtual_memory().available
+    except (psutil.Error, OSError):
+        return 0
+    return int(available * magick_memory_share / max(1, workers))
+
+def get_large_image_budget(memory_budget, workers):
+    """Return the memory for the one large image converted at a time.
+
+    The other workers keep their ``memory_budget`` each, so the large image
+    gets what they leave of the share of the memory available now, and no
+    less than a worker's own budget.
+    """
+    workers = max(1, workers)
+    memory_budget = memory_budget or get_memory_budget(workers)
+    return max(memory_budget, get_memory_budget(1) - (workers - 1) * memory_budget)
+
+def get_magick_limit_args(memory_budget, thread_budget=0, large=False):
+    """Return the -limit options for one magick run with ``memory_budget`` bytes."""
+    args = []
+    if memory_budget:
+        memory = max(memory_budget // (1024 * 1024), 64)
+        # Memory-mapped cache counts against the same RAM; a large image
+        # gets no extra map so it spills to disk right after the heap.
+        args += ["-limit", "memory", f"{memory}MiB", "-limit", "map", f"{memory if large else 2 * memory}MiB"]
+    if thread_budget:
+        args += ["-limit", "thread", str(thread_budget)]
+    return args
+
+def is_large_image(input_path):
+    size = get_file_size(input_path)
+    if size < large_image_min_bytes:
+        return False
+    if os.path.splitext(input_path)[1].lower() in pillow_extensions:
+        try:
+            with Image.open(input_path) as image:
+                width, height = image.size
+            return width * height >= large_image_pixels
+        except Image.DecompressionBombError:
+            return True
+        except Exception:
+            pass
+    info = probe_media(input_path)
+    streams = info.streams_of("video") if info else []
+    if not streams or not streams[0].width:
+        # Unreadable for ffprobe (e.g. some raw formats): judge by size.
+        return size >= large_image_fallback_bytes
+    return streams[0].width * streams[0].height >= large_image_pixels
+
+# Inputs the in-process path takes when Pillow can open them. ICO is left to
+# ffmpeg, which picks its frame differently, and DNG/JXR are not decoded by
+# Pillow properly.
+pillow_candidate_extensions = [".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tiff", ".webp", ".heic", ".avif"]
+pillow_extensions = set(
+    ext for ext in pillow_candidate_extensions if pillow_available and ext in Image.registered_extensions()
+)
+pillow_modes = ("1", "L", "LA", "P", "PA", "RGB", "RGBA")
+# EXIF tags the tool chain does not copy into PNG outputs.
+png_skipped_exif_tags = (0x011A, 0x011B, 0x0128, 0x0102)
+
+def can_convert_with_pillow(image, target):
+    if getattr(image, "n_frames", 1) > 1 or image.mode not in pillow_modes:
+        return False
+    if image.width * image.height >= large_image_pixels:
+        return False
+    # IPTC (JPEG APP13) only survives through exiftool.
+    if target == "PNG" and any(marker == "APP13" for marker, _ in getattr(image, "applist", [])):
+        return False
+    return True
+
+def save_jpg_with_pillow(image, output_path):
+    # Same result as the magick path: no metadata but the density, 4:4:4
+    # chroma at quality 95. Transparency is flattened onto white.
+    if image.mode in ("1", "L"):
+        output = image.convert("L")
+    elif image.mode in ("LA", "PA", "RGBA") or "transparency" in image.info:
+        rgba = image.convert("RGBA")
+        output = Image.new("RGB", rgba.size, (255, 255, 255))
+        output.paste(rgba, mask=rgba.getchannel("A"))
+    else:
+        output = image.convert("RGB")
+    params = {"quality": 95, "subsampling": 0}
+    if image.info.get("dpi"):
+        params["dpi"] = tuple(round(float(value)) for value in image.info["dpi"])
+    output.save(output_path, "JPEG", **params)
+
+def save_png_with_pillow(image, output_path):
+    # RGBA like the ffmpeg path, with EXIF, ICC, XMP and text written in the
+    # same pass instead of by exiftool afterwards.
+    params = {}
+    exif = image.getexif()
+    for tag in png_skipped_exif_tags:
+        exif.pop(tag, None)
+    if len(exif):
+        params["exif"] = exif.tobytes()
+    if image.info.get("icc_profile"):
+        params["icc_profile"] = image.info["icc_profile"]
+    pnginfo = PngImagePlugin.PngInfo()
+    text = dict(getattr(image, "text", {}))
+    xmp = image.info.get("xmp")
+    if xmp and "XML:com.adobe.xmp" not in text:
+        text["XML:com.adobe.xmp"] = xmp.decode("utf-8", errors="replace") if isinstance(xmp, bytes) else xmp
+    for key, value in text.items():
+        pnginfo.add_itxt(key, str(value))
+    image.convert("RGBA").save(output_path, "PNG", pnginfo=pnginfo, **params)
+
+def convert_image_with_pillow(input_path, output_path, target, stats_callback=None, ico_sizes=None, **options):
+    """Convert an image inside this process; None when the tools should do it.
+
+    Small everyday images cost far more to spawn ffmpeg, magick and exiftool
+    for than to decode. Anything Pillow cannot take as a plain single-frame
+    8-bit image, or fails to read, is left to the tool chain.
+    """
+    if os.path.splitext(input_path)[1].lower() not in pillow_extensions:
+        return None
+    start_cpu = time.thread_time()
+    try:
+        with Image.open(input_path) as image:
+            if not can_convert_with_pillow(image, target):
+                return None
+            if target == "JPG":
+                save_jpg_with_pillow(image, output_path)
+            elif target == "ICO":
+                save_ico_with_pillow(image, output_path, ico_sizes or default_ico_sizes)
+            else:
+                save_png_with_pillow(image, output_path)
+    except Exception:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+    if stats_callback:
+        stats_callback({"cpu_seconds": time.thread_time() - start_cpu})
+    return subprocess.CompletedProcess(args=["pillow", input_path, output_path], returncode=0, stdout="", stderr="")
+
+def convert_image_to_jpg(input_path, output_path, progress_callback, memory_budget=0, thread_budget=0, fast_images=True, workers=0, **options):
+    if fast_images:
+        result = convert_image_with_pillow(input_path, output_path, "JPG", **options)
+        if result is not None:
+            return result
+    if is_large_image(input_path):
+        # One large image at a time, with what the other workers leave.
+        with large_image_slots:
+            limit_args = get_magick_limit_args(get_large_image_budget(memory_budget, workers or get_worker_count("JPG")), thread_budget, large=True)
+            return run_tool([magick_path, *limit_args, input_path, *jpg_magick_args, output_path], **options)
+    limit_args = get_magick_limit_args(memory_budget or get_memory_budget(get_worker_count("JPG")), thread_budget)
+    return run_tool([magick_path, *limit_args, input_path, *jpg_magick_args, output_path], **options)
+
+# Longest command line a batch may build; Windows caps the whole
+# command line at 32767 characters. Each batched file adds its two paths and
+# about this many characters of options.
+max_batch_command_length = 30000
+batch_entry_overhead = {"JPG": 150, "ICO": 600, "PNG": 100}
+
+def run_magick_batch(pairs, results, image_args, limit_args, **options):
+    """Convert the pairs whose result is still None in one magick process.
+
+    ``image_args(input_path)`` returns the options applied to an image
+    between reading and writing it. Each image is read, written with -write
+    and dropped from the list before the next one is read, so memory use
+    stays that of a single image. Fills in one CompletedProcess per pair;
+    when magick fails, or a pair's output is missing afterwards, the pairs
+    are reported as failed so the caller can retry them one by one.
+    """
+    remaining = [index for index, result in enumerate(results) if result is None]
+    if not remaining:
+        return results
+    cmd = [magick_path, *limit_args]
+    for index in remaining:
+        input_path, output_path = pairs[index]
+        cmd += [input_path, *image_args(input_path), "-write", output_path, "-delete", "0--1"]
+    cmd.append("null:")
+    result = run_tool(cmd, **options)
+    for index in remaining:
+        # A run that failed may have died in the middle of any output, so
+        # then all of them are retried on their own.
+        output_path = pairs[index][1]
+        written = result.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 0
+        results[index] = subprocess.CompletedProcess(
+            args=cmd, returncode=0 if written else 1, stdout="", stderr=result.stderr
+        )
+    return results
+
+def convert_images_to_jpg_batch(pairs, progress_callback, memory_budget=0, thread_budget=0, fast_images=True, stats_callback=None, **options):
+    """Convert several (input, output) pairs in one magick process.
+
+    With ``fast_images``, what Pillow can convert never reaches magick.
+    """
+    results = [None] * len(pairs)
+    if fast_images:
+        results = [convert_image_with_pillow(input_path, output_path, "JPG", stats_callback=stats_callback) for input_path, output_path in pairs]
+    limit_args = get_magick_limit_args(memory_budget or get_memory_budget(get_worker_count("JPG")), thread_budget)
+    return run_magick_batch(pairs, results, lambda input_path: jpg_magick_args, limit_args, stats_callback=stats_callback, **options)
+
+# Frame sizes written into ICO files unless configured otherwise.
+default_ico_sizes = [16, 24, 32, 48, 64, 256]
+# Unsharp mask per icon size when scaling down: (largest size, sigma,
+# amount). Small sizes lose the most detail and get the strongest mask.
+ico_sharpening = [(32, 0.8, 1.0), (64, 0.6, 0.7), (128, 0.5, 0.4)]
+
+def parse_ico_sizes(text):
+    """Parse "16,32,256" into sorted unique sizes; ICO frames are 1-256 pixels."""
+    sizes = sorted({int(value) for value in text.replace(" ", "").split(",") if value})
+    if not sizes or sizes[0] < 1 or sizes[-1] > 256:
+        raise ValueError(f"Icon sizes must be between 1 and 256: {text}")
+    return sizes
+
+def get_ico_sharpening(size):
+    for largest, sigma, amount in ico_sharpening:
+        if size <= largest:
+            return sigma, amount
+    return None
+
+def get_image_extent(input_path):
+    """Return the longer side of an image in pixels, or 0 when unknown."""
+    if os.path.splitext(input_path)[1].lower() in pillow_extensions:
+        try:
+            with Image.open(input_path) as image:
+                return max(image.size)
+        except Exception:
+            pass
+    info = probe_media(input_path)
+    streams = info.streams_of("video") if info else []
+    if not streams or not streams[0].width:
+        return 0
+    return max(streams[0].width, streams[0].height)
+
+def get_ico_magick_args(sizes, extent=0):
+    # Every size is cloned from the one decoded frame, scaled to fit and
+    # centered on a transparent square. Like make_icon_frame, only sizes
+    # scaled down from the source's longer side ``extent`` are sharpened;
+    # a source of unknown size is assumed to be larger.
+    args = ["-delete", "1--1", "-background", "none", "-gravity", "center"]
+    for size in sizes:
+        args += ["(", "-clone", "0", "-resize", f"{size}x{size}"]
+        sharpening = get_ico_sharpening(size)
+        if sharpening and (not extent or size < extent):
+            args += ["-unsharp", f"0x{sharpening[0]}+{sharpening[1]}+0.02"]
+        args += ["-extent", f"{size}x{size}", ")"]
+    return args + ["-delete", "0"]
+
+def make_icon_frame(source, size):
+    scale = size / max(source.size)
+    width, height = max(1, round(source.width * scale)), max(1, round(source.height * scale))
+    frame = source.resize((width, height), Image.LANCZOS)
+    sharpening = get_ico_sharpening(size)
+    if scale < 1 and sharpening:
+        frame = frame.filter(ImageFilter.UnsharpMask(radius=sharpening[0], percent=int(sharpening[1] * 100), threshold=2))
+    canvas = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    canvas.paste(frame, ((size - width) // 2, (size - height) // 2))
+    return canvas
+
+def save_ico_with_pillow(image, output_path, sizes):
+    source = image.convert("RGBA")
+    # Pillow writes the sizes it finds among the frames; the largest has to
+    # come first.
+    frames = [make_icon_frame(source, size) for size in sorted(sizes, reverse=True)]
+    frames[0].save(output_path, "ICO", sizes=[frame.size for frame in frames], append_images=frames[1:])
+
+def convert_image_to_ico(input_path, output_path, progress_callback, ico_sizes=None, memory_budget=0, thread_budget=0, fast_images=True, workers=0, **options):
+    """Write an icon with a frame per size, all from a single decode."""
+    sizes = ico_sizes or default_ico_sizes
+    if fast_images:
+        result = convert_image_with_pillow(input_path, output_path, "ICO", ico_sizes=sizes, **options)
+        if result is not None:
+            return result
+    if is_large_image(input_path):
+        with large_image_slots:
+            limit_args = get_magick_limit_args(get_large_image_budget(memory_budget, workers or get_worker_count("ICO")), thread_budget, large=True)
+            return run_tool([magick_path, *limit_args, input_path, *get_ico_magick_args(sizes, get_image_extent(input_path)), output_path], **options)
+    limit_args = get_magick_limit_args(memory_budget or get_memory_budget(get_worker_count("ICO")), thread_budget)
+    return run_tool([magick_path, *limit_args, input_path, *get_ico_magick_args(sizes, get_image_extent(input_path)), output_path], **options)
+
+def convert_images_to_ico_batch(pairs, progress_callback, ico_sizes=None, memory_budget=0, thread_budget=0, fast_images=True, stats_callback=None, **options):
+    """Convert several (input, output) pairs to icons in one magick process.
+
+    Each source is decoded once and its sized frames written together.
+    """
+    sizes = ico_sizes or default_ico_sizes
+    results = [None] * len(pairs)
+    if fast_images:
+        results = [convert_image_with_pillow(input_path, output_path, "ICO", ico_sizes=sizes, stats_callback=stats_callback) for input_path, output_path in pairs]
+    limit_args = get_magick_limit_args(memory_budget or get_memory_budget(get_worker_count("ICO")), thread_budget)
+    return run_magick_batch(pairs, results, lambda input_path: get_ico_magick_args(sizes, get_image_extent(input_path)), limit_args, stats_callback=stats_callback, **options)
+
+class ExifToolSession:
+    """A long-running ``exiftool -stay_open True -@ -`` process.
+
+    Commands are written to its stdin one argument per line and terminated
+    with ``-execute``; exiftool answers with ``{ready}`` when done, so Perl
+    starts once per session instead of once per image.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = start_process(
+            [exiftool_path, "-stay_open", "True", "-@", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="replace"
+        )
+        ffmpeg_processes.add(self.process.pid)
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, args):
+        with self.lock:
+            if not self.is_running():
+                self.start()
+            lines = ["-charset", "filename=utf8", *args, "-execute"]
+            self.process.stdin.write("\n".join(lines) + "\n")
+            self.process.stdin.flush()
+            output = []
+            for line in self.process.stdout:
+                if line.strip() == "{ready}":
+                    break
+                output.append(line)
+            else:
+                raise OSError("exiftool session ended unexpectedly")
+        return "".join(output)
+
+    def execute_many(self, commands):
+        """Run several commands in one exchange and return their outputs.
+
+        All commands are written before the first answer is read, each
+        ended by a numbered ``-executeN`` so its ``{readyN}`` can be told
+        apart. The answers are a line or two each and fit the pipe buffer
+        while the commands are still being written.
+        """
+        if not commands:
+            return []
+        with self.lock:
+            if not self.is_running():
+                self.start()
+            lines = []
+            for number, args in enumerate(commands, 1):
+                lines += ["-charset", "filename=utf8", *args, f"-execute{number}"]
+            self.process.stdin.write("\n".join(lines) + "\n")
+            self.process.stdin.flush()
+            outputs = []
+            output = []
+            for line in self.process.stdout:
+                if line.strip() == f"{{ready{len(outputs) + 1}}}":
+                    outputs.append("".join(output))
+                    output = []
+                    if len(outputs) == len(commands):
+                        break
+                else:
+                    output.append(line)
+            else:
+                raise OSError("exiftool session ended unexpectedly")
+        return outputs
+
+    def close(self):
+        with self.lock:
+            if not self.is_running():
+                return
+            try:
+                self.process.stdin.write("-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.wait(5)
+            except (OSError, subprocess.TimeoutExpired):
+                terminate_process_tree(self.process.pid)
+            ffmpeg_processes.discard(self.process.pid)
+
+exiftool_sessions = []
+exiftool_local = threading.local()
+
+def get_exiftool_session():
+    session = getattr(exiftool_local, "session", None)
+    if session is None:
+        session = ExifToolSession()
+        exiftool_local.session = session
+        exiftool_sessions.append(session)
+    return session
+
+def close_exiftool_session():
+    """Close the calling thread's session; worker threads do so when they end."""
+    session = getattr(exiftool_local, "session", None)
+    if session is None:
+        return
+    exiftool_local.session = None
+    session.close()
+    if session in exiftool_sessions:
+        exiftool_sessions.remove(session)
+
+def close_exiftool_sessions():
+    for session in list(exiftool_sessions):
+        session.close()
+
+atexit.register(close_exiftool_sessions)
+
+def get_metadata_copy_args(input_path, output_path):
+    return ["-tagsfromfile", input_path, "-all:all", "-XResolution", "-YResolution", "-ResolutionUnit", "-BitsPerSample", "-overwrite_original", output_path]
+
+def parse_exiftool_result(args, output):
+    # A session reports no exit status per command. Like exiftool's own, it
+    # only fails on errors; "0 image files updated, 1 unchanged" means the
+    # source had nothing to copy.
+    failed = re.search(r"^Error|weren't updated due to errors", output, re.MULTILINE)
+    returncode = 1 if failed else 0
+    return subprocess.CompletedProcess(args=args, returncode=returncode, stdout=output, stderr="" if returncode == 0 else output)
+
+def copy_metadata(input_path, output_path):
+    args = get_metadata_copy_args(input_path, output_path)
+    try:
+        return parse_exiftool_result(args, get_exiftool_session().execute(args))
+    except OSError as e:
+        return subprocess.CompletedProcess(args=args, returncode=1, stdout="", stderr=str(e))
+
+def copy_metadata_batch(pairs):
+    """Copy metadata for many (input, output) pairs through one session."""
+    commands = [get_metadata_copy_args(input_path, output_path) for input_path, output_path in pairs]
+    try:
+        outputs = get_exiftool_session().execute_many(commands)
+    except OSError as e:
+        return [subprocess.CompletedProcess(args=args, returncode=1, stdout="", stderr=str(e)) for args in commands]
+    return [parse_exiftool_result(args, output) for args, output in zip(commands, outputs)]
+
+def convert_image_to_png(input_path, output_path, progress_callback, fast_images=True, **options):
+    if fast_images:
+        result = convert_image_with_pillow(input_path, output_path, "PNG", **options)
+        if result is not None:
+            return result
+    cmd1 = [ffmpeg_path, "-i", input_path, "-c:v", "png", "-frames:v", "1", "-pix_fmt", "rgba", output_path]
+    result1 = run_tool(cmd1, **options)
+    if result1.returncode != 0:
+        return result1
+    progress_callback(50)
+    return copy_metadata(input_path, output_path)
+
+def convert_images_to_png_batch(pairs, progress_callback, fast_images=True, stats_callback=None, **options):
+    """Convert several (input, output) pairs to PNG with one ffmpeg process.
+
+    ffmpeg reads every input and writes each output in one run, then the
+    metadata of all outputs is copied in a single exchange with the
+    worker's exiftool session. ffmpeg stops at the first bad input, so on
+    failure every pair is reported failed and retried on its own.
+    """
+    results = [None] * len(pairs)
+    if fast_images:
+        results = [convert_image_with_pillow(input_path, output_path, "PNG", stats_callback=stats_callback) for input_path, output_path in pairs]
+    remaining = [index for index, result in enumerate(results) if result is None]
+    if not remaining:
+        return results
+    cmd = [ffmpeg_path]
+    for index in remaining:
+        cmd += ["-i", pairs[index][0]]
+    for number, index in enumerate(remaining):
+        cmd += ["-map", f"{number}:v:0", "-c:v", "png", "-frames:v", "1", "-pix_fmt", "rgba", pairs[index][1]]
+    result = run_tool(cmd, stats_callback=stats_callback, **options)
+    if result.returncode != 0:
+        for index in remaining:
+            results[index] = subprocess.CompletedProcess(args=cmd, returncode=result.returncode, stdout="", stderr=result.stderr)
+        return results
+    progress_callback(50)
+    for index, metadata_result in zip(remaining, copy_metadata_batch([pairs[index] for index in remaining])):
+        results[index] = metadata_result
+    return results
+
+conversion_functions = {
+    "Video": {"MP4": convert_video_to_mp4, "MKV": convert_video_to_mkv, "WebM": convert_video_to_webm},
+    "Audio": {"M4A": convert_audio_to_m4a, "FLAC": convert_audio_to_flac},
+    "Image": {"ICO": convert_image_to_ico, "JPG": convert_image_to_jpg, "PNG": convert_image_to_png},
+}
+
+# Converters that can take a whole list of files in one tool invocation.
+batch_conversion_functions = {
+    "Image": {"JPG": convert_images_to_jpg_batch, "ICO": convert_images_to_ico_batch, "PNG": convert_images_to_png_batch},
+}
+
+# Types whose formats can be written together by one convert_to_formats run.
+multi_format_types = ("Video", "Audio")
+
+def is_valid_file(file_path, conversion_type):
+    if not os.path.exists(file_path):
+        return False
+    return extension_types.get(os.path.splitext(file_path)[1].lower()) == conversion_type
+
+def reserve_output_file(input_file, extension, reserved=None, preferred=None):
+    """Claim a free output name next to ``input_file`` and return it.
+
+    The name is taken by creating an empty placeholder with O_EXCL, so two
+    jobs (or two Morph instances) can never end up with the same name. The
+    finished output replaces the placeholder in publish_output().
+    """
+    base_name = os.path.splitext(input_file)[0]
+    candidates = [preferred] if preferred else []
+    candidates.append(f"{base_name}.{extension.lower()}")
+    suffix = 1
+    while True:
+        for output_file in candidates:
+            if reserved is not None and output_file in reserved:
+                continue
+            try:
+                os.close(os.open(output_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            if reserved is not None:
+                reserved.add(output_file)
+            return output_file
+        candidates = [f"{base_name}_{suffix}.{extension.lower()}"]
+        suffix += 1
+
+def get_partial_file(output_file):
+    directory, name = os.path.split(output_file)
+    return os.path.join(directory, f".morph-partial-{name}")
+
+def get_scratch_file(scratch_dir, output_file):
+    key = hashlib.sha1(os.path.abspath(output_file).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(scratch_dir, f"{key}-{os.path.basename(output_file)}")
+
+def publish_output(staging_path, output_path):
+    """Move a finished output over its reserved name in one step."""
+    try:
+        os.replace(staging_path, output_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # The scratch dir is on another drive: copy next to the target first so
+    # the final name still only ever shows a complete file.
+    temp_path = get_partial_file(output_path) + ".copy"
+    try:
+        shutil.copyfile(staging_path, temp_path)
+        os.replace(temp_path, output_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.remove(staging_path)
+
+def link_or_copy(source_path, target_path):
+    """Hardlink ``source_path`` to ``target_path``, or copy it across drives."""
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+# The quick fingerprint hashes this many blocks of this size, spread evenly
+# over the file from its first to its last byte.
+fingerprint_blocks = 8
+fingerprint_block_size = 64 * 1024
+
+def get_fingerprint(path, full_hash=False):
+    """Return a content fingerprint of ``path``: its size and a SHA-1.
+
+    By default only sampled blocks are hashed, which costs a few reads no
+    matter how large the file is; files that differ only between the
+    samples would match, and ``full_hash`` hashes every byte instead.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        if full_hash or size <= fingerprint_blocks * fingerprint_block_size:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        else:
+            step = (size - fingerprint_block_size) // (fingerprint_blocks - 1)
+            for i in range(fingerprint_blocks):
+                f.seek(i * step)
+                digest.update(f.read(fingerprint_block_size))
+    return f"{size}-{'full' if full_hash else 'sampled'}-{digest.hexdigest()}"
+
+def get_content_key(fingerprint, conversion_type, selected_format, settings):
+    """Key of an output: the source's fingerprint plus what shapes the result."""
+    text = json.dumps([fingerprint, conversion_type, selected_format, settings], sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# Threads a single encoder process keeps busy on its own; the default worker
+# count divides the available cores by this so parallel jobs don't oversubscribe.
+encoder_threads = {
+    "MP4": 4,
+    "MKV": 1,
+    "WebM": 4,
+    "M4A": 1,
+    "FLAC": 1,
+    "ICO": 1,
+    "JPG": 1,
+    "PNG": 1,
+}
+
+# Concurrent stream copies; more mostly makes them seek against each other.
+default_io_workers = 2
+
+def get_worker_count(selected_format, configured=0):
+    if configured > 0:
+        return configured
+    cores = os.cpu_count() or 1
+    return max(1, cores // encoder_threads.get(selected_format, 1))
+
+def get_job_lane(conversion_type, selected_format, input_path, remux=True):
+    """Return "io" when the job's command only copies streams, else "cpu".
+
+    Stream copies are bound by the disk and encodes by the cores, so each
+    gets its own lane in BatchConverter. The decision mirrors what the
+    converter will plan for the file.
+    """
+    if conversion_type == "Image":
+        return "cpu"
+    if selected_format == "MKV":
+        return "io"
+    info = probe_media(input_path)
+    if info is None:
+        return "cpu"
+    if conversion_type == "Audio":
+        return "io" if info.codec_of("audio") in audio_copy_codecs[selected_format] else "cpu"
+    if not info.streams_of("video"):
+        return "cpu"
+    for stream, action, _ in plan_streams(info, selected_format, remux):
+        if action == "encode" and stream.codec_type in ("video", "audio"):
+            return "cpu"
+    return "io"
+
+def get_conversion_type(selected_format):
+    for conversion_type, formats in conversion_functions.items():
+        for fmt in formats:
+            if fmt.lower() == selected_format.lower():
+                return conversion_type, fmt
+    return None, None
+
+def parse_formats(value):
+    """Return the conversion type and formats of a comma-separated --to."""
+    conversion_type = None
+    formats = []
+    for name in value.split(","):
+        name_type, selected_format = get_conversion_type(name.strip())
+        if not selected_format:
+            raise ValueError(f"Unknown format: {name.strip()}")
+        if conversion_type and name_type != conversion_type:
+            raise ValueError(f"Formats of one batch must be of the same type: {value}")
+        conversion_type = name_type
+        if selected_format not in formats:
+            formats.append(selected_format)
+    return conversion_type, formats
+
+def scan_files(paths, conversion_type, seen_callback=None):
+    """Yield the files under ``paths`` that ``conversion_type`` accepts.
+
+    Folders are walked top-down with os.scandir, which gets the entry type
+    from the directory listing itself, so skipped files are never stat'ed.
+    Matches are yielded as they are found, while the walk continues.
+    ``seen_callback`` is called for every file looked at.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            if os.path.isfile(path):
+                if seen_callback:
+                    seen_callback()
+                if extension_types.get(os.path.splitext(path)[1].lower()) == conversion_type:
+                    yield path
+            continue
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            subdirectories = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir():
+                                # Like os.walk, do not follow directory links.
+                                if not entry.is_symlink():
+                                    subdirectories.append(entry.path)
+                                continue
+                        except OSError:
+                            continue
+                        if seen_callback:
+                            seen_callback()
+                        if extension_types.get(os.path.splitext(entry.name)[1].lower()) == conversion_type:
+                            yield entry.path
+            except OSError:
+                continue
+            directories.extend(reversed(subdirectories))
+
+# Jobs found by a scan are handed to the workers at most this many at a time.
+dispatch_chunk_size = 64
+# A live run skips outputs it wrote when they come back as inputs for this
+# long after their job finished; a watcher reports them well within it.
+recent_output_time = 3600
+
+class ConversionJob:
+    def __init__(self, input_path, conversion_type, selected_format):
+        self.input_path = input_path
+        self.conversion_type = conversion_type
+        self.selected_format = selected_format
+        self.output_path = None
+        self.state = "queued"
+        self.error = None
+        self.progress = 0.0
+        self.elapsed = 0.0
+        self.message = ""
+        self.stats = {}
+        self.plan = None
+        self.processes = []
+        self.probe_time = 0.0
+        self.lane = None
+        self.staging_path = None
+        self.scratch_bytes = 0
+        self.returncode = None
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.content_key = None
+        self.duplicates = []
+        self.reused = None
+
+    def metrics(self):
+        return {
+            "exit_reason": self.error or self.state,
+            "returncode": self.returncode,
+            "wall_time": round(self.elapsed, 3),
+            "probe_time": round(self.probe_time, 3),
+            "fps": self.stats.get("fps", 0.0),
+            "speed": self.stats.get("speed", 0.0),
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "peak_rss": self.stats.get("peak_rss", 0),
+            "cpu_seconds": round(self.stats.get("cpu_seconds", 0.0), 3),
+        }
+
+    def to_dict(self):
+        return {
+            "input": self.input_path,
+            "output": self.output_path,
+            "type": self.conversion_type,
+            "format": self.selected_format,
+            "state": self.state,
+            "error": self.error,
+            "message": self.message,
+            "plan": self.plan,
+            "elapsed": round(self.elapsed, 3),
+            "lane": self.lane,
+            "reused": self.reused,
+            "metrics": self.metrics(),
+        }
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+class BatchJournal:
+    """Append-only record of a batch, so an interrupted run can be resumed.
+
+    Every line is a JSON object: one "batch" header with the settings and
+    the files and folders given, then one "job" entry per state change
+    (queued, running, done, failed, cancelled) with the job's output path.
+    A "scanned" entry marks that every folder has been walked; without it a
+    resume walks them again for the files not reached yet. Each append is
+    fsync'd.
+    """
+
+    pending_states = ("queued", "running", "cancelled")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, records, truncate=False):
+        with self.lock:
+            with open(self.path, "w" if truncate else "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start_batch(self, conversion_type, selected_format, settings, paths, resume=False, formats=None):
+        header = {
+            "event": "batch",
+            "type": conversion_type,
+            "format": selected_format,
+            "formats": formats or [selected_format],
+            "settings": settings,
+            "paths": [os.path.abspath(path) for path in paths],
+            "time": time.time(),
+        }
+        self.append([header], truncate=not resume)
+
+    def mark_scanned(self):
+        self.append([{"event": "scanned", "time": time.time()}])
+
+    def job_record(self, job):
+        output_path = os.path.abspath(job.output_path) if job.output_path else None
+        return {"event": "job", "input": os.path.abspath(job.input_path), "format": job.selected_format, "output": output_path, "state": job.state, "time": time.time()}
+
+    def record(self, job):
+        self.append([self.job_record(job)])
+
+    def add_jobs(self, jobs):
+        self.append([self.job_record(job) for job in jobs])
+
+    def load(self):
+        header = None
+        jobs = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave a torn last line.
+                        continue
+                    if record.get("event") == "batch":
+                        header = record
+                    elif record.get("event") == "scanned" and header is not None:
+                        header["scanned"] = True
+                    elif record.get("event") == "job":
+                        jobs[(record["input"], record.get("format"))] = record
+        except OSError:
+            pass
+        return header, jobs
+
+    def pending_jobs(self):
+        """Return the batch header and what is left to convert.
+
+        Besides the unfinished jobs this includes the batch's paths when
+        its scan did not complete; BatchConverter.run(resume=True) skips
+        the files the journal already knows.
+        """
+        header, records = self.load()
+        if header is None:
+            return None, []
+        jobs = []
+        for record in records.values():
+            if record["state"] not in self.pending_states:
+                continue
+            job = ConversionJob(record["input"], header["type"], record.get("format") or header["format"])
+            # Only a job that was running can have left a partial output
+            # behind; it is replaced under the same name.
+            if record["state"] != "queued":
+                job.output_path = record["output"]
+            jobs.append(job)
+        if not header.get("scanned"):
+            jobs.extend(header.get("paths", []))
+        return header, jobs
+
+    def clear(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class MetricsRecorder:
+    """Per-job metrics of every batch, for spotting throughput regressions.
+
+    Each batch writes batch-<time>-<pid>.jsonl into the metrics directory,
+    one line per finished job. With a textfile path, cumulative counters are
+    also kept there in the Prometheus text format for node_exporter's
+    textfile collector; the file is replaced atomically after each batch.
+    """
+
+    def __init__(self, directory, textfile=None):
+        self.directory = directory
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.path = None
+
+    def start_batch(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = time.strftime("batch-%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl"
+        self.path = os.path.join(self.directory, name)
+
+    def record(self, job):
+        if not self.path:
+            return
+        line = json.dumps(job.to_dict(), ensure_ascii=False)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def finish_batch(self, jobs):
+        self.path = None
+        if self.textfile:
+            self.write_textfile(jobs)
+
+    def read_counters(self):
+        counters = {}
+        try:
+            with open(self.textfile, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip() or line.startswith("#"):
+                        continue
+                    key, _, value = line.rstrip("\n").rpartition(" ")
+                    if not key.split("{")[0].endswith("_total"):
+                        continue
+                    try:
+                        counters[key] = float(value)
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return counters
+
+    def write_textfile(self, jobs):
+        counters = self.read_counters()
+
+        def add(name, labels, value):
+            key = name
+            if labels:
+                key += "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+            counters[key] = counters.get(key, 0.0) + value
+
+        add("morph_batches_total", [], 1)
+        for job in jobs:
+            labels = [("type", job.conversion_type), ("format", job.selected_format)]
+            metrics = job.metrics()
+            add("morph_jobs_total", labels + [("state", job.state)], 1)
+            add("morph_job_wall_seconds_total", labels, metrics["wall_time"])
+            add("morph_job_probe_seconds_total", labels, metrics["probe_time"])
+            add("morph_job_cpu_seconds_total", labels, metrics["cpu_seconds"])
+            add("morph_input_bytes_total", labels, metrics["input_bytes"])
+            add("morph_output_bytes_total", labels, metrics["output_bytes"])
+
+        lines = []
+        for name in sorted({key.split("{")[0] for key in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for key in sorted(k for k in counters if k.split("{")[0] == name):
+                value = counters[key]
+                lines.append(f"{key} {int(value) if value.is_integer() else round(value, 6)}")
+        lines.append("# TYPE morph_last_batch_timestamp_seconds gauge")
+        lines.append(f"morph_last_batch_timestamp_seconds {time.time():.0f}")
+
+        directory = os.path.dirname(os.path.abspath(self.textfile))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(temp_path, self.textfile)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+# Files in the cache directory without an index entry are removed once they
+# are this old. Younger ones may be stored by another process right now.
+cache_orphan_age = 24 * 3600
+
+class ResultCache:
+    """Finished outputs kept across runs, keyed by source content and settings.
+
+    Entries are files named after their key in the cache directory, stored
+    and handed out as copies, so editing an output in place never changes
+    the cached file or other outputs made from it.
+    index.json records each entry's size and last use and is saved after
+    every store; once the entries exceed ``max_mb``, the least recently used
+    are evicted. Processes sharing the directory merge their entries into
+    the index when they save it.
+    """
+
+    def __init__(self, directory, max_mb=2048):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.index_file = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.loaded = False
+
+    def read_index(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {
+            key: entry for key, entry in entries.items()
+            if os.path.exists(os.path.join(self.directory, entry["file"]))
+        }
+
+    def load(self):
+        # Called under the lock; old files without an index entry were left
+        # by a run that ended before it could index them.
+        if self.loaded:
+            return
+        self.loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        entries = self.read_index()
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]["used"]):
+            self.entries[key] = entry
+        known = {entry["file"] for entry in self.entries.values()}
+        for name in os.listdir(self.directory):
+            if name == "index.json" or name in known:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if time.time() - os.path.getmtime(path) >= cache_orphan_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def fetch(self, key, target_path):
+        """Put the cached output for ``key`` at ``target_path``; False on a miss."""
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            entry["used"] = time.time()
+            self.entries.move_to_end(key)
+        try:
+            shutil.copyfile(os.path.join(self.directory, entry["file"]), target_path)
+        except OSError:
+            # Evicted meanwhile, or removed by hand.
+            if os.path.exists(target_path):
+                os.remove(target_path)
+            return False
+        return True
+
+    def store(self, key, source_path):
+        size = get_file_size(source_path)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self.lock:
+            self.load()
+        name = key + os.path.splitext(source_path)[1].lower()
+        temp_path = os.path.join(self.directory, f".{name}.{threading.get_ident()}.tmp")
+        try:
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, os.path.join(self.directory, name))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self.lock:
+            self.entries[key] = {"file": name, "size": size, "used": time.time()}
+            self.entries.move_to_end(key)
+            total = sum(entry["size"] for entry in self.entries.values())
+            while self.max_bytes and total > self.max_bytes:
+                _, entry = self.entries.popitem(last=False)
+                total -= entry["size"]
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except OSError:
+                    pass
+        # Saved right away, so an unclean exit loses no entries.
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            # Entries another process added since; its evicted files are
+            # gone and drop out on their own.
+            for key, entry in self.read_index().items():
+                if key not in self.entries:
+                    self.entries[key] = entry
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self.entries, f)
+                os.replace(temp_path, self.index_file)
+            except OSError:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+class BatchConverter:
+    def __init__(self, conversion_type, selected_format, max_workers=0, progress_callback=None, error_callback=None, job_callback=None, remux=True, batch_size=16, journal=None, segment_parallel=False, metrics=None, scan_callback=None, io_workers=0, scratch_dir=None, scratch_quota_mb=0, profile=None, extra_formats=(), result_cache=None, dedupe=True, full_hash=False, priority="normal", io_priority="normal", pin_cores=False, fast_images=True, ico_sizes=None):
+        self.conversion_type = conversion_type
+        self.ico_sizes = list(ico_sizes or default_ico_sizes)
+        self.fast_images = fast_images
+        self.priority = priority
+        self.io_priority = io_priority
+        self.pin_cores = pin_cores
+        self.worker_state = threading.local()
+        self.result_cache = result_cache
+        self.dedupe = dedupe
+        self.full_hash = full_hash
+        self.formats = [selected_format] + [f for f in extra_formats if f != selected_format]
+        # Several formats of one input come from a single decode.
+        self.multi_format = len(self.formats) > 1 and conversion_type in multi_format_types
+        self.profile = profile if profile in encoding_profiles else default_profile
+        self.scratch_dir = scratch_dir
+        self.scratch_quota = scratch_quota_mb * 1024 * 1024
+        self.scratch_used = 0
+        self.io_workers = io_workers or default_io_workers
+        self.scan_callback = scan_callback
+        self.journal = journal
+        self.metrics = metrics
+        self.segment_parallel = segment_parallel
+        self.selected_format = selected_format
+        self.remux = remux
+        self.batch_size = batch_size
+        self.conversion_funcs = {f: conversion_functions[conversion_type][f] for f in self.formats}
+        self.batch_func = batch_conversion_functions.get(conversion_type, {}).get(selected_format) if len(self.formats) == 1 else None
+        self.max_workers = min(get_worker_count(f, max_workers) for f in self.formats)
+        self.progress_callback = progress_callback
+        self.error_callback = error_callback
+        self.job_callback = job_callback
+        self.is_cancelled = False
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.reserved_outputs = set()
+        self.failed_files = 0
+        self.progress_sum = 0.0
+        self.found_files = 0
+        self.last_scan_report = 0.0
+        self.leaders = {}
+        self.recent_outputs = {}
+        self.live = False
+
+    def stop(self):
+        self.is_cancelled = True
+        for job in list(self.jobs):
+            for process in list(job.processes):
+                if process.poll() is None:
+                    terminate_process_tree(process.pid)
+
+    def update_progress(self, job, progress):
+        with self.lock:
+            progress = min(max(progress, 0), 100)
+            self.progress_sum += progress - job.progress
+            job.progress = progress
+            total = len(self.jobs)
+            overall = self.progress_sum / total if total > 0 else 100
+        if self.progress_callback:
+            self.progress_callback(min(overall, 100))
+
+    def finish_job(self, job, state, error=None, params=None):
+        self.release_scratch(job)
+        job.state = state
+        job.error = error
+        job.input_bytes = get_file_size(job.input_path)
+        job.output_bytes = get_file_size(job.output_path) if state == "done" else 0
+        self.record_job(job)
+        if self.metrics:
+            try:
+                self.metrics.record(job)
+            except OSError:
+                pass
+        if state == "failed":
+            with self.lock:
+                self.failed_files += 1
+            if self.error_callback:
+                self.error_callback(error, params or {})
+        if state != "cancelled":
+            self.update_progress(job, 100)
+        if self.job_callback:
+            self.job_callback(job)
+        self.finish_duplicates(job)
+        if self.live:
+            self.forget_job(job)
+
+    def forget_job(self, job):
+        # A live run never ends; what it holds for finished jobs must go.
+        with self.lock:
+            if self.leaders.get(job.content_key) is job:
+                del self.leaders[job.content_key]
+            self.reserved_outputs.discard(job.staging_path)
+            if job.output_path in self.reserved_outputs:
+                self.reserved_outputs.discard(job.output_path)
+                if job.state == "done":
+                    self.recent_outputs[job.output_path] = time.monotonic()
+            # Oldest first, as they were added.
+            expired = time.monotonic() - recent_output_time
+            while self.recent_outputs:
+                path = next(iter(self.recent_outputs))
+                if self.recent_outputs[path] >= expired:
+                    break
+                del self.recent_outputs[path]
+
+    def finish_duplicates(self, job):
+        # Copies of the same source were held back until it finished.
+        with self.lock:
+            duplicates, job.duplicates = job.duplicates, []
+        for duplicate in duplicates:
+            if job.state == "done" and not self.is_cancelled:
+                if self.prepare_job(duplicate):
+                    self.reuse_output(duplicate, job.output_path, "duplicate")
+            elif job.state == "failed":
+                duplicate.message = job.message
+                self.finish_job(duplicate, "failed", job.error, {"file": duplicate.input_path})
+            else:
+                self.finish_job(duplicate, "cancelled")
+
+    def reuse_output(self, job, source_path, reused):
+        try:
+            link_or_copy(source_path, job.staging_path)
+        except OSError as e:
+            self.fail_job(job, e)
+            return
+        job.reused = reused
+        self.complete_job(job, subprocess.CompletedProcess(args="", returncode=0, stdout="", stderr=""))
+
+    def restore_cached(self, job):
+        """Finish ``job`` from the result cache; False when it has to convert."""
+        if not self.result_cache or not job.content_key:
+            return False
+        start_time = time.monotonic()
+        try:
+            found = self.result_cache.fetch(job.content_key, job.staging_path)
+        except OSError:
+            found = False
+        if not found:
+            return False
+        job.elapsed = time.monotonic() - start_time
+        job.reused = "cache"
+        self.complete_job(job, subprocess.CompletedProcess(args="", returncode=0, stdout="", stderr=""))
+        return True
+
+    def record_job(self, job):
+        if self.journal:
+            try:
+                self.journal.record(job)
+            except OSError:
+                pass
+
+    def remove_output(self, output_file):
+        if output_file and os.path.exists(output_file):
+            try:
+                os.remove(output_file)
+            except Exception:
+                pass
+
+    def get_staging_path(self, job):
+        # Encode into the local scratch dir while it has room, otherwise
+        # under a hidden name next to the output.
+        if self.scratch_dir:
+            # Rough estimate: outputs are usually about as large as inputs.
+            estimate = get_file_size(job.input_path)
+            with self.lock:
+                fits = not self.scratch_quota or self.scratch_used + estimate <= self.scratch_quota
+                if fits:
+                    try:
+                        fits = shutil.disk_usage(self.scratch_dir).free - self.scratch_used > estimate
+                    except OSError:
+                        fits = False
+                if fits:
+                    self.scratch_used += estimate
+                    job.scratch_bytes = estimate
+                    return get_scratch_file(self.scratch_dir, job.output_path)
+        return get_partial_file(job.output_path)
+
+    def release_scratch(self, job):
+        with self.lock:
+            self.scratch_used -= job.scratch_bytes
+            job.scratch_bytes = 0
+
+    def discard_outputs(self, job):
+        self.remove_output(job.staging_path)
+        self.remove_output(job.output_path)
+
+    def prepare_job(self, job):
+        self.release_scratch(job)
+        job.state = "running"
+        input_file = job.input_path
+        if not os.path.exists(input_file):
+            self.finish_job(job, "failed", "file_access_error", {"file": input_file})
+            return False
+
+        try:
+            with open(input_file, 'rb') as f:
+                pass
+            with self.lock:
+                preferred = None
+                if job.output_path:
+                    # Resumed or retried job: drop whatever the earlier run
+                    # left behind and write to the same name again.
+                    self.remove_output(job.output_path)
+                    self.remove_output(get_partial_file(job.output_path))
+                    if self.scratch_dir:
+                        self.remove_output(get_scratch_file(self.scratch_dir, job.output_path))
+                    self.reserved_outputs.discard(job.output_path)
+                    preferred = job.output_path
+                job.output_path = reserve_output_file(input_file, job.selected_format, self.reserved_outputs, preferred)
+            job.staging_path = self.get_staging_path(job)
+            with self.lock:
+                self.reserved_outputs.add(job.staging_path)
+        except Exception as e:
+            self.finish_job(job, "failed", "file_access_error", {"file": input_file})
+            return False
+        self.record_job(job)
+        return True
+
+    def complete_job(self, job, result):
+        job.processes = []
+        job.returncode = result.returncode
+        if self.is_cancelled:
+            self.discard_outputs(job)
+            self.finish_job(job, "cancelled")
+        elif result.returncode != 0:
+            self.discard_outputs(job)
+            job.message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ""
+            self.finish_job(job, "failed", "conversion_error", {"file": job.input_path})
+        elif not os.path.exists(job.staging_path):
+            self.discard_outputs(job)
+            self.finish_job(job, "failed", "output_not_created", {"file": job.output_path})
+        else:
+            try:
+                publish_output(job.staging_path, job.output_path)
+            except OSError as e:
+                self.discard_outputs(job)
+                job.message = str(e)
+                self.finish_job(job, "failed", "output_not_created", {"file": job.output_path})
+                return
+            if self.result_cache and job.content_key and not job.reused:
+                try:
+                    self.result_cache.store(job.content_key, job.output_path)
+                except OSError:
+                    pass
+            self.finish_job(job, "done")
+
+    def fail_job(self, job, error):
+        job.processes = []
+        self.discard_outputs(job)
+        job.message = str(error)
+        self.finish_job(job, "failed", "conversion_error", {"file": job.input_path})
+
+    def update_stats(self, job, stats):
+        # Resource usage arrives once per tool run; a job can run several.
+        with self.lock:
+            stats = dict(stats)
+            if "cpu_seconds" in stats:
+                stats["cpu_seconds"] += job.stats.get("cpu_seconds", 0.0)
+            if "peak_rss" in stats:
+                stats["peak_rss"] = max(stats["peak_rss"], job.stats.get("peak_rss", 0))
+            job.stats.update(stats)
+
+    def probe_job(self, job):
+        if self.conversion_type not in ("Video", "Audio"):
+            return 0.0
+        start_time = time.monotonic()
+        probe_media(job.input_path)
+        return time.monotonic() - start_time
+
+    def classify_job(self, job):
+        # The probe result stays cached for the converter itself.
+        job.probe_time = self.probe_job(job)
+        job.lane = get_job_lane(self.conversion_type, job.selected_format, job.input_path, self.remux)
+        if self.dedupe or self.result_cache:
+            try:
+                fingerprint = get_fingerprint(job.input_path, self.full_hash)
+            except OSError:
+                return
+            # The profile's settings, not its name: an edited tier in
+            # profiles.ini must not get outputs made with the old one.
+            settings = {"remux": self.remux, "profile": encoding_profiles[self.profile], "fast_images": self.fast_images, "ico_sizes": self.ico_sizes}
+            job.content_key = get_content_key(fingerprint, self.conversion_type, job.selected_format, settings)
+
+    def hold_duplicate(self, job):
+        """Attach ``job`` to an earlier job of this batch with the same source.
+
+        The duplicate is not queued; it gets the earlier job's output once
+        that finishes, or right away when it already has. It is converted
+        itself only when the earlier job failed or was cancelled.
+        """
+        if not self.dedupe or not job.content_key:
+            return False
+        with self.lock:
+            leader = self.leaders.setdefault(job.content_key, job)
+            if leader is job:
+                return False
+            if leader.state in ("queued", "running"):
+                leader.duplicates.append(job)
+                return True
+            if leader.state != "done" or not os.path.exists(leader.output_path):
+                # Later copies wait for this one instead.
+                self.leaders[job.content_key] = job
+                return False
+        if self.prepare_job(job):
+            self.reuse_output(job, leader.output_path, "duplicate")
+        return True
+
+    def get_job_options(self, job):
+        def progress_callback(progress):
+            if self.is_cancelled:
+                return
+            self.update_progress(job, progress)
+
+        # Captured here, in the worker thread: segment encodes start their
+        # tools from helper threads.
+        cores = getattr(self.worker_state, "cores", None)
+
+        def process_callback(process):
+            job.processes = [p for p in job.processes if p.poll() is None] + [process]
+            apply_process_limits(process.pid, self.priority, self.io_priority, cores)
+            if self.is_cancelled:
+                terminate_process_tree(process.pid)
+
+        if cores:
+            thread_budget = len(cores)
+        else:
+            thread_budget = max(1, (os.cpu_count() or 1) // self.max_workers)
+        return {
+            "progress_callback": progress_callback,
+            "stats_callback": lambda stats: self.update_stats(job, stats),
+            "process_callback": process_callback,
+            "plan_callback": lambda summary: setattr(job, "plan", summary),
+            "remux": self.remux,
+            "segment_parallel": self.segment_parallel,
+            "profile": self.profile,
+            "thread_budget": thread_budget,
+            "segment_budget": self.get_segment_budget(thread_budget, cores),
+            "memory_budget": get_memory_budget(self.max_workers),
+            "workers": self.max_workers,
+            "fast_images": self.fast_images,
+            "ico_sizes": self.ico_sizes,
+        }
+
+    def get_segment_budget(self, thread_budget, cores):
+        """Return how many threads a long video may split across segments.
+
+        While jobs wait, a job keeps its worker's share. Once none is left,
+        the cores of the idle workers go to the jobs still running, so the
+        last long files of a batch do not run on a single share. Pinned
+        workers keep their cores.
+        """
+        if not self.segment_parallel or cores:
+            return thread_budget
+        with self.lock:
+            active = [job for job in self.jobs if job.lane != "io" and job.state in ("queued", "running")]
+            # Duplicates wait for their leader, not for a worker.
+            held = {id(duplicate) for job in active for duplicate in job.duplicates}
+        active = [job for job in active if id(job) not in held]
+        if any(job.state == "queued" for job in active):
+            return thread_budget
+        return max(thread_budget, (os.cpu_count() or 1) // max(1, len(active)))
+
+    def convert_job(self, job):
+        start_time = time.monotonic()
+        if self.prepare_job(job) and not self.restore_cached(job):
+            try:
+                result = self.conversion_funcs[job.selected_format](input_path=job.input_path, output_path=job.staging_path, **self.get_job_options(job))
+                job.elapsed = time.monotonic() - start_time
+                self.complete_job(job, result)
+            except Exception as e:
+                job.elapsed = time.monotonic() - start_time
+                self.fail_job(job, e)
+
+    def get_shared_options(self, jobs):
+        # All jobs share one process; cancelling any of them terminates it.
+        options = self.get_job_options(jobs[0])
+        process_callback = options["process_callback"]
+
+        def shared_process_callback(process):
+            process_callback(process)
+            for job in jobs:
+                job.processes = [process]
+
+        options["process_callback"] = shared_process_callback
+
+        def stats_callback(stats):
+            # Split what the shared process used evenly across its outputs.
+            if "cpu_seconds" in stats:
+                stats = dict(stats, cpu_seconds=stats["cpu_seconds"] / len(jobs))
+            for job in jobs:
+                self.update_stats(job, stats)
+
+        options["stats_callback"] = stats_callback
+        return options
+
+    def complete_shared(self, jobs, results, elapsed):
+        for job, result in zip(jobs, results):
+            job.elapsed = elapsed
+            if result.returncode == 0 or self.is_cancelled:
+                self.complete_job(job, result)
+            else:
+                # Retry on its own so one bad file or output does not fail
+                # the rest.
+                self.convert_job(job)
+
+    def convert_batch(self, jobs):
+        start_time = time.monotonic()
+        jobs = [job for job in jobs if self.prepare_job(job) and not self.restore_cached(job)]
+        if not jobs:
+            return
+        options = self.get_shared_options(jobs)
+        try:
+            results = self.batch_func([(job.input_path, job.staging_path) for job in jobs], **options)
+        except Exception as e:
+            results = [subprocess.CompletedProcess(args="", returncode=1, stdout="", stderr=str(e)) for _ in jobs]
+        self.complete_shared(jobs, results, (time.monotonic() - start_time) / len(jobs))
+
+    def convert_formats(self, jobs):
+        start_time = time.monotonic()
+        jobs = [job for job in jobs if self.prepare_job(job) and not self.restore_cached(job)]
+        if not jobs:
+            return
+        options = self.get_shared_options(jobs)
+        options["conversion_type"] = self.conversion_type
+        del options["plan_callback"]
+
+        def progress_callback(progress):
+            # The outputs are written side by side and advance together.
+            if self.is_cancelled:
+                return
+            for job in jobs:
+                self.update_progress(job, progress)
+
+        options["progress_callback"] = progress_callback
+        outputs = [
+            (job.selected_format, job.staging_path, lambda summary, job=job: setattr(job, "plan", summary))
+            for job in jobs
+        ]
+        try:
+            results = convert_to_formats(jobs[0].input_path, outputs, **options)
+        except Exception as e:
+            results = [subprocess.CompletedProcess(args="", returncode=1, stdout="", stderr=str(e)) for _ in jobs]
+        # Each output took the whole run.
+        self.complete_shared(jobs, results, time.monotonic() - start_time)
+
+    def group_batches(self, jobs):
+        batches = []
+        by_directory = {}
+        for job in jobs:
+            by_directory.setdefault(os.path.dirname(job.input_path), []).append(job)
+        for directory_jobs in by_directory.values():
+            batch = []
+            length = 0
+            for job in directory_jobs:
+                entry_length = 2 * len(job.input_path) + batch_entry_overhead[self.selected_format]
+                if batch and (len(batch) >= self.batch_size or length + entry_length > max_batch_command_length):
+                    batches.append(batch)
+                    batch = []
+                    length = 0
+                batch.append(job)
+                length += entry_length
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def group_formats(self, jobs):
+        by_input = OrderedDict()
+        for job in jobs:
+            by_input.setdefault(job.input_path, []).append(job)
+        return [group if len(group) > 1 else group[0] for group in by_input.values()]
+
+    def plan_report(self):
+        report = {"remuxed": 0, "encoded": 0, "copied": 0, "dropped": 0}
+        planned = [job.plan for job in self.jobs if job.plan and job.state == "done"]
+        for plan in planned:
+            report["remuxed" if plan["encoded"] == 0 else "encoded"] += 1
+            report["copied"] += plan["copied"]
+            report["dropped"] += plan["dropped"]
+        return report if planned else None
+
+    def worker(self, pending, cores=None):
+        self.worker_state.cores = cores
+        try:
+            while True:
+                unit = pending.get()
+                if unit is None or self.is_cancelled:
+                    break
+                if isinstance(unit, list) and self.multi_format:
+                    self.convert_formats(unit)
+                elif isinstance(unit, list):
+                    self.convert_batch(unit)
+                else:
+                    self.convert_job(unit)
+        finally:
+            # Each run starts new workers; their sessions would outlive it.
+            close_exiftool_session()
+
+    def report_scan(self, force=False):
+        if not self.scan_callback:
+            return
+        now = time.monotonic()
+        if force or now - self.last_scan_report >= progress_interval:
+            self.last_scan_report = now
+            self.scan_callback(self.found_files, len(self.jobs))
+
+    def count_seen_file(self):
+        self.found_files += 1
+        self.report_scan()
+
+    def iter_inputs(self, files, known_inputs):
+        # Folders are walked here, on the producer side, so conversion can
+        # start on the first match. Yields the jobs of one input at a time,
+        # one per target format.
+        group = []
+        for input_file in files:
+            if isinstance(input_file, ConversionJob):
+                if group and group[0].input_path != input_file.input_path:
+                    yield group
+                    group = []
+                self.count_seen_file()
+                group.append(input_file)
+                continue
+            if group:
+                yield group
+                group = []
+            for path in scan_files([input_file], self.conversion_type, self.count_seen_file):
+                # The walk can meet files this batch has just written.
+                with self.lock:
+                    if path in self.reserved_outputs or self.recent_outputs.pop(path, None):
+                        continue
+                if known_inputs and os.path.abspath(path) in known_inputs:
+                    continue
+                yield [ConversionJob(path, self.conversion_type, selected_format) for selected_format in self.formats]
+        if group:
+            yield group
+
+    def dispatch(self, jobs, intake):
+        # Journal the jobs as queued before any worker can mark them running.
+        if self.journal:
+            try:
+                self.journal.add_jobs(jobs)
+            except OSError:
+                pass
+        if self.multi_format:
+            units = self.group_formats(jobs)
+        elif self.batch_func and self.batch_size > 1:
+            units = self.group_batches(jobs)
+        else:
+            units = jobs
+        for unit in units:
+            intake.put(unit)
+
+    def route(self, unit, lanes):
+        """Classify the jobs of ``unit`` and hand them to their lane."""
+        jobs = unit if isinstance(unit, list) else [unit]
+        for job in jobs:
+            self.classify_job(job)
+        jobs = [job for job in jobs if not self.hold_duplicate(job)]
+        if isinstance(unit, list) and not self.multi_format:
+            # Converted on their own through the large-image path.
+            large = [is_large_image(job.input_path) for job in jobs]
+            for job in [job for job, is_large in zip(jobs, large) if is_large]:
+                lanes[job.lane].put(job)
+            jobs = [job for job, is_large in zip(jobs, large) if not is_large]
+        if len(jobs) > 1:
+            lanes["cpu" if any(job.lane == "cpu" for job in jobs) else "io"].put(jobs)
+        elif jobs:
+            lanes[jobs[0].lane].put(jobs[0])
+
+    def classifier(self, intake, lanes):
+        # Probing and fingerprinting run here, several files at a time, so
+        # neither the scan nor the lanes wait on one ffprobe after another.
+        while True:
+            unit = intake.get()
+            if unit is None or self.is_cancelled:
+                break
+            self.route(unit, lanes)
+
+    def queue_jobs(self, files, intake, lanes, known_inputs):
+        chunk = []
+        for group in self.iter_inputs(files, known_inputs):
+            if self.is_cancelled:
+                break
+            with self.lock:
+                if self.live:
+                    # A live run never ends; only unfinished jobs are kept.
+                    self.jobs = [job for job in self.jobs if job.state in ("queued", "running")]
+                self.jobs.extend(group)
+            chunk.extend(group)
+            # Hand jobs over in chunks, or right away when a lane is idle.
+            # Live inputs may pause at any point, so theirs go right away.
+            if self.live or len(chunk) >= dispatch_chunk_size or any(lane.empty() for lane in lanes.values()):
+                self.dispatch(chunk, intake)
+                chunk = []
+            self.report_scan()
+        if chunk:
+            self.dispatch(chunk, intake)
+        if self.journal and not self.is_cancelled:
+            try:
+                self.journal.mark_scanned()
+            except OSError:
+                pass
+        self.report_scan(force=True)
+
+    def run(self, files, resume=False, live=False):
+        """Convert ``files``: paths of files and folders, or ConversionJobs.
+
+        Folders are scanned while the workers already convert what has been
+        found, so the total grows until the scan ends. Jobs that only copy
+        streams run in an "io" lane with ``io_workers`` slots, apart from
+        the ``max_workers`` slots of the "cpu" lane, so remuxes and encodes
+        overlap instead of competing. Jobs are probed and fingerprinted by
+        as many classifier threads as there are workers before they reach
+        their lane.
+
+        With ``live``, ``files`` is an iterator that blocks until the next
+        path arrives, like the watch daemon's queue. Each path is converted
+        as soon as it arrives and the run ends with the iterator.
+        """
+        self.live = live
+        if not live:
+            files = list(files)
+        self.jobs = []
+        self.failed_files = 0
+        self.progress_sum = 0.0
+        self.found_files = 0
+        self.last_scan_report = 0.0
+        self.reserved_outputs = set()
+        self.leaders = {}
+        self.recent_outputs = {}
+        known_inputs = None
+        if self.journal:
+            settings = {"remux": self.remux, "batch_size": self.batch_size, "segment_parallel": self.segment_parallel, "profile": self.profile, "dedupe": self.dedupe, "full_hash": self.full_hash, "fast_images": self.fast_images, "ico_sizes": self.ico_sizes}
+            paths = [] if live else [input_file for input_file in files if not isinstance(input_file, ConversionJob)]
+            if resume:
+                # Files the interrupted run already found are either done or
+                # among the resumed jobs, and its outputs are no inputs; a
+                # repeated scan must skip both.
+                records = self.journal.load()[1]
+                known_inputs = {record["input"] for record in records.values()} | {record["output"] for record in records.values() if record["output"]}
+            try:
+                self.journal.start_batch(self.conversion_type, self.selected_format, settings, paths, resume, self.formats)
+            except OSError:
+                self.journal = None
+        if self.metrics:
+            try:
+                self.metrics.start_batch()
+            except OSError:
+                self.metrics = None
+        if self.scratch_dir:
+            try:
+                os.makedirs(self.scratch_dir, exist_ok=True)
+            except OSError:
+                self.scratch_dir = None
+
+        lanes = {"cpu": queue.Queue(), "io": queue.Queue()}
+        lane_workers = {"cpu": max(1, self.max_workers), "io": max(1, self.io_workers)}
+        workers = []
+        for lane, count in lane_workers.items():
+            for slot in range(count):
+                # Stream copies barely use the CPU and are left unpinned.
+                cores = get_worker_cores(slot, count) if self.pin_cores and lane == "cpu" else None
+                workers.append((lane, threading.Thread(target=self.worker, args=(lanes[lane], cores), daemon=True)))
+        intake = queue.Queue()
+        classifiers = [threading.Thread(target=self.classifier, args=(intake, lanes), daemon=True) for _ in workers]
+        for _, worker in workers:
+            worker.start()
+        for classifier in classifiers:
+            classifier.start()
+        try:
+            self.queue_jobs(files, intake, lanes, known_inputs)
+        finally:
+            for _ in classifiers:
+                intake.put(None)
+            for classifier in classifiers:
+                classifier.join()
+            for lane, _ in workers:
+                lanes[lane].put(None)
+        for _, worker in workers:
+            worker.join()
+        if self.is_cancelled:
+            for job in self.jobs:
+                if job.state == "queued":
+                    job.state = "cancelled"
+        elif self.journal:
+            self.journal.clear()
+        if self.metrics:
+            try:
+                self.metrics.finish_batch(self.jobs)
+            except OSError:
+                pass
+        if self.result_cache:
+            self.result_cache.save()
+        media_cache.save()
+        return self.jobs
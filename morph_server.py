@@ -0,0 +1,429 @@
+"""
+Morph
+Copyright (C) 2025 Alexander Nemchinov
+https://linktr.ee/Nemchinov
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import json
+import stat
+import time
+import queue
+import socket
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from morph_core import (
+    BatchConverter,
+    parse_formats,
+    encoding_profiles,
+    priority_levels,
+    progress_interval,
+)
+
+default_api_port = 8765
+# Finished batches kept for status queries; older ones are forgotten.
+kept_batches = 200
+# Events a slow listener may fall behind by before new ones are dropped.
+listener_backlog = 1000
+# An idle event stream sends a ping this often to notice closed clients.
+event_ping_interval = 15
+# Host headers accepted over TCP; anything else is a web page reaching the
+# port through a rebound DNS name.
+allowed_hosts = ("127.0.0.1", "localhost")
+# Order in which queued batches start, by priority; equal ones go first in,
+# first out. A running batch is never interrupted.
+queue_ranks = {"normal": 0, "low": 1, "idle": 2}
+
+class QueuedBatch:
+    """One submission: a BatchConverter and the paths it converts."""
+
+    def __init__(self, batch_id, converter, files, resume=False, source="api", priority="normal"):
+        self.id = batch_id
+        self.converter = converter
+        self.files = files
+        self.resume = resume
+        self.source = source
+        self.queue_priority = priority
+        self.state = "queued"
+        self.error = None
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.last_progress_event = 0.0
+
+    def progress(self):
+        if self.state == "finished":
+            return 100.0
+        jobs = len(self.converter.jobs)
+        return min(self.converter.progress_sum / jobs, 100.0) if jobs else 0.0
+
+    def to_dict(self, files=False):
+        converter = self.converter
+        data = {
+            "id": self.id,
+            "source": self.source,
+            "state": self.state,
+            "error": self.error,
+            "type": converter.conversion_type,
+            "formats": converter.formats,
+            "profile": converter.profile,
+            "priority": converter.priority,
+            "queue_priority": self.queue_priority,
+            "progress": round(self.progress(), 1),
+            "files": len(converter.jobs),
+            "failed": converter.failed_files,
+            "submitted": self.submitted,
+        }
+        if files:
+            data["jobs"] = [job.to_dict() for job in list(converter.jobs)]
+        return data
+
+class ConversionQueue:
+    """Batches from every intake, converted one after another.
+
+    The GUI and the job API submit their BatchConverters here, so one warm
+    process runs them one at a time, by priority and then in order of
+    submission, instead of letting them fight over the cores. Listeners
+    receive each state change, each finished file and, at most every
+    ``progress_interval`` seconds per batch, its progress.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = OrderedDict()
+        self.pending = queue.PriorityQueue()
+        self.listeners = []
+        self.next_id = 1
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self):
+        listener = queue.Queue(listener_backlog)
+        with self.lock:
+            self.listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def publish(self, event):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def publish_state(self, batch):
+        self.publish(dict(batch.to_dict(), event="batch"))
+
+    def submit(self, converter, files, resume=False, source="api", priority=None):
+        """Queue a batch; ``priority`` (default: the converter's) picks its turn."""
+        priority = priority or converter.priority
+        with self.lock:
+            batch = QueuedBatch(str(self.next_id), converter, files, resume, source, priority)
+            order = (queue_ranks.get(priority, 0), self.next_id)
+            self.next_id += 1
+            self.batches[batch.id] = batch
+            finished = [b.id for b in self.batches.values() if b.done.is_set()]
+            for batch_id in finished[:max(0, len(finished) - kept_batches)]:
+                del self.batches[batch_id]
+
+        # Report through the queue on top of the callbacks the intake set.
+        job_callback = converter.job_callback
+        progress_callback = converter.progress_callback
+
+        def report_job(job):
+            if job_callback:
+                job_callback(job)
+            self.publish(dict(job.to_dict(), event="file", id=batch.id))
+
+        def report_progress(progress):
+            if progress_callback:
+                progress_callback(progress)
+            now = time.monotonic()
+            if now - batch.last_progress_event >= progress_interval:
+                batch.last_progress_event = now
+                self.publish({"event": "progress", "id": batch.id, "progress": round(progress, 1)})
+
+        converter.job_callback = report_job
+        converter.progress_callback = report_progress
+        self.publish_state(batch)
+        self.pending.put((*order, batch))
+        return batch
+
+    def get(self, batch_id):
+        with self.lock:
+            return self.batches.get(batch_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.batches.values())
+
+    def cancel(self, batch_id):
+        batch = self.get(batch_id)
+        if batch is None:
+            return None
+        with self.lock:
+            queued = batch.state == "queued"
+            if queued:
+                batch.state = "cancelled"
+        batch.converter.stop()
+        if queued:
+            batch.done.set()
+            self.publish_state(batch)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.pending.get()[-1]
+            if batch is None:
+                break
+            with self.lock:
+                if batch.state != "queued":
+                    continue
+                batch.state = "running"
+            self.publish_state(batch)
+            try:
+                batch.converter.run(batch.files, batch.resume)
+                batch.state = "cancelled" if batch.converter.is_cancelled else "finished"
+            except Exception as e:
+                batch.state = "failed"
+                batch.error = str(e)
+            batch.done.set()
+            self.publish_state(batch)
+
+    def shutdown(self):
+        for batch in self.list():
+            if not batch.done.is_set():
+                self.cancel(batch.id)
+        self.pending.put((-1, 0, None))
+        self.thread.join()
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    server_version = "Morph"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_route(self):
+        return [part for part in self.path.split("?", 1)[0].split("/") if part]
+
+    def is_local_request(self):
+        """Refuse requests a web page in a local browser could send."""
+        # Browsers add Origin to cross-site and scripted requests; the
+        # programs this API is for do not.
+        if "Origin" in self.headers:
+            self.send_json(403, {"error": "Requests from web pages are not accepted"})
+            return False
+        if not self.server.job_server.socket_path:
+            if (self.headers.get("Host") or "").rsplit(":", 1)[0] not in allowed_hosts:
+                self.send_json(403, {"error": "Unexpected Host header"})
+                return False
+        return True
+
+    def do_GET(self):
+        if not self.is_local_request():
+            return
+        conversion_queue = self.server.job_server.conversion_queue
+        route = self.get_route()
+        if route == ["jobs"]:
+            self.send_json(200, [batch.to_dict() for batch in conversion_queue.list()])
+        elif len(route) == 2 and route[0] == "jobs":
+            batch = conversion_queue.get(route[1])
+            if batch is None:
+                self.send_json(404, {"error": "Unknown job"})
+            else:
+                self.send_json(200, batch.to_dict(files=True))
+        elif route == ["events"]:
+            self.stream_events(conversion_queue)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if not self.is_local_request():
+            return
+        conversion_queue = self.server.job_server.conversion_queue
+        route = self.get_route()
+        if route == ["jobs"]:
+            # Browsers send text/plain forms without a preflight; JSON needs one.
+            if self.headers.get_content_type() != "application/json":
+                self.send_json(415, {"error": "Content-Type must be application/json"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                batch = self.server.job_server.submit(request)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            self.send_json(201, batch.to_dict())
+        elif len(route) == 3 and route[0] == "jobs" and route[2] == "cancel":
+            batch = conversion_queue.cancel(route[1])
+            if batch is None:
+                self.send_json(404, {"error": "Unknown job"})
+            else:
+                self.send_json(200, batch.to_dict())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def stream_events(self, conversion_queue):
+        # One JSON object per line until the client disconnects.
+        listener = conversion_queue.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while not self.server.job_server.is_stopped:
+                try:
+                    event = listener.get(timeout=event_ping_interval)
+                except queue.Empty:
+                    event = {"event": "ping"}
+                self.wfile.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            conversion_queue.unsubscribe(listener)
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+if hasattr(socket, "AF_UNIX"):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            # A socket left by an earlier run would make bind fail; any
+            # other file at the path is left alone and bind reports it.
+            try:
+                if stat.S_ISSOCK(os.lstat(self.server_address).st_mode):
+                    os.remove(self.server_address)
+            except FileNotFoundError:
+                pass
+            # Created owner-only, so it is never reachable by others.
+            umask = os.umask(0o177)
+            try:
+                super().server_bind()
+            finally:
+                os.umask(umask)
+
+class JobServer:
+    """Local job API of a ConversionQueue.
+
+    Serves HTTP on 127.0.0.1:``port``, or on the Unix socket
+    ``socket_path``, which only its owner may connect to:
+
+    - POST /jobs with {"paths": [...], "format": "mp4" or "mp4,webm",
+      optional "type", "profile", "priority" and "io_priority"} queues a job
+      and returns it; paths must be absolute. "priority" both lowers the
+      encoders' CPU priority and lets normal jobs start before queued low
+      and idle ones
+    - GET /jobs lists the jobs, GET /jobs/<id> adds the state of every file
+    - POST /jobs/<id>/cancel cancels a queued or running job
+    - GET /events streams the events of all jobs as JSON lines
+
+    ``get_settings`` returns the BatchConverter keyword arguments that jobs
+    start from, such as max_workers and result_cache.
+    """
+
+    def __init__(self, conversion_queue, get_settings=None, port=default_api_port, socket_path=None):
+        self.conversion_queue = conversion_queue
+        self.get_settings = get_settings or dict
+        self.port = port
+        self.socket_path = socket_path
+        self.server = None
+        self.thread = None
+        self.is_stopped = False
+
+    @property
+    def address(self):
+        return self.socket_path or f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        if self.socket_path:
+            if not hasattr(socket, "AF_UNIX"):
+                raise OSError("Unix sockets are not available on this system")
+            self.server = UnixHTTPServer(self.socket_path, JobRequestHandler)
+        else:
+            self.server = LocalHTTPServer(("127.0.0.1", self.port), JobRequestHandler)
+        self.server.job_server = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_stopped = True
+        if not self.server:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path:
+            try:
+                if stat.S_ISSOCK(os.lstat(self.socket_path).st_mode):
+                    os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object")
+        paths = request.get("paths")
+        if isinstance(paths, str):
+            paths = [paths]
+        if not paths or not all(isinstance(path, str) for path in paths):
+            raise ValueError("paths must be a list of file or folder paths")
+        if not all(os.path.isabs(path) for path in paths):
+            raise ValueError("paths must be absolute")
+        files = [path for path in paths if os.path.exists(path)]
+        if not files:
+            raise ValueError("No valid files found")
+        for key in ("format", "type", "profile", "priority", "io_priority"):
+            if key in request and not isinstance(request[key], str):
+                raise ValueError(f"{key} must be a string")
+        if not request.get("format"):
+            raise ValueError("format is required")
+        conversion_type, formats = parse_formats(request["format"])
+        if request.get("type") and request["type"].lower() != conversion_type.lower():
+            raise ValueError(f"{', '.join(formats)} is {conversion_type}, not {request['type']}")
+
+        settings = dict(self.get_settings())
+        settings["extra_formats"] = formats[1:]
+        if "profile" in request:
+            if request["profile"] not in encoding_profiles:
+                raise ValueError(f"Unknown profile: {request['profile']} (available: {', '.join(encoding_profiles)})")
+            settings["profile"] = request["profile"]
+        for key in ("priority", "io_priority"):
+            if key in request:
+                if request[key] != "normal" and request[key] not in priority_levels:
+                    raise ValueError(f"Unknown {key}: {request[key]}")
+                settings[key] = request[key]
+        converter = BatchConverter(conversion_type, formats[0], **settings)
+        return self.conversion_queue.submit(converter, files)
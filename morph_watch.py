@@ -0,0 +1,297 @@
+"""
+Morph
+Copyright (C) 2025 Alexander Nemchinov
+https://linktr.ee/Nemchinov
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software Foundation,
+Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+from morph_core import extension_types
+
+# Flags and event bits from <sys/inotify.h>.
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+event_header = struct.Struct("iIII")
+
+# A file nobody is seen closing counts as written once its size and mtime
+# have not changed for this long: copies over the network, or any file when
+# folders are polled.
+default_settle_time = 3.0
+# How often folders without an inotify watch are checked for changes.
+default_poll_interval = 2.0
+# Longest wait for events before pending files are looked at again.
+watch_tick = 0.5
+
+def load_inotify():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+inotify = load_inotify()
+
+def get_file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def iter_queue(pending):
+    """Yield what is put into ``pending`` until None arrives."""
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        yield item
+
+class FolderWatcher:
+    """Report files that arrive in watched folders once they are written.
+
+    ``rules`` are dicts with at least "path", "conversion_type" and
+    "recursive". run() calls ``ready_callback(rule, path)`` for each file of
+    the rule's type that its writer has closed, that was moved in, or whose
+    size and mtime have not changed for ``settle_time`` seconds. On Linux
+    the folders are watched with inotify; elsewhere, or for folders past the
+    inotify watch limit, their mtimes are polled and only changed folders
+    are listed again. Names starting with a dot are ignored, which covers
+    Morph's partial outputs and the temporary files of most copy tools.
+    Files already there at start are only reported with ``existing``.
+    """
+
+    def __init__(self, rules, ready_callback, settle_time=default_settle_time, poll_interval=default_poll_interval, existing=False, use_inotify=True):
+        self.rules = rules
+        self.ready_callback = ready_callback
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.existing = existing
+        self.use_inotify = use_inotify and inotify is not None
+        self.is_stopped = False
+        self.fd = None
+        # directory -> [rule, mtime, watched]
+        self.directories = {}
+        self.watches = {}
+        # Files already reported or there at start, with their (size, mtime).
+        self.known = {}
+        # Files still being written: path -> [rule, (size, mtime), last change]
+        self.pending = {}
+
+    def stop(self):
+        self.is_stopped = True
+
+    def is_candidate(self, rule, name):
+        if name.startswith("."):
+            return False
+        return extension_types.get(os.path.splitext(name)[1].lower()) == rule["conversion_type"]
+
+    def add_directory(self, root, rule, initial=False):
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            if directory in self.directories:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            watched = False
+            if self.fd is not None:
+                # Watch before listing, so nothing created in between is lost.
+                wd = inotify.inotify_add_watch(self.fd, os.fsencode(directory), watch_mask)
+                if wd >= 0:
+                    self.watches[wd] = directory
+                    watched = True
+            self.directories[directory] = [rule, mtime, watched]
+            subdirectories = self.list_directory(directory, rule, initial)
+            if rule["recursive"]:
+                directories.extend(subdirectories)
+
+    def forget_directory(self, root):
+        for directory in [d for d in self.directories if d == root or d.startswith(root + os.sep)]:
+            del self.directories[directory]
+        for wd, directory in list(self.watches.items()):
+            if directory == root or directory.startswith(root + os.sep):
+                del self.watches[wd]
+                inotify.inotify_rm_watch(self.fd, wd)
+
+    def list_directory(self, directory, rule, initial=False):
+        """Note the new or changed files of ``directory``; return its subfolders."""
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink() and not entry.name.startswith("."):
+                                subdirectories.append(entry.path)
+                            continue
+                        if not self.is_candidate(rule, entry.name):
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    state = (stat.st_size, stat.st_mtime_ns)
+                    if initial and not self.existing:
+                        self.known[entry.path] = state
+                    elif self.known.get(entry.path) != state:
+                        self.note_file(entry.path, rule, state)
+        except OSError:
+            pass
+        return subdirectories
+
+    def note_file(self, path, rule, state=None):
+        state = state or get_file_state(path)
+        if state is None:
+            self.pending.pop(path, None)
+            return
+        entry = self.pending.get(path)
+        if entry is None or entry[1] != state:
+            self.pending[path] = [rule, state, time.monotonic()]
+
+    def hand_over(self, path, rule):
+        state = get_file_state(path)
+        if state is None or state[0] == 0:
+            # Gone again, or created empty and still to be written.
+            self.note_file(path, rule, state)
+            return
+        self.pending.pop(path, None)
+        if self.known.get(path) == state:
+            return
+        self.known[path] = state
+        self.ready_callback(rule, path)
+
+    def check_pending(self):
+        now = time.monotonic()
+        for path, entry in list(self.pending.items()):
+            state = get_file_state(path)
+            if state is None:
+                del self.pending[path]
+            elif state != entry[1]:
+                entry[1], entry[2] = state, now
+            elif now - entry[2] >= self.settle_time:
+                self.hand_over(path, entry[0])
+
+    def poll_directories(self):
+        for directory, entry in list(self.directories.items()):
+            if entry[2] or directory not in self.directories:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                self.forget_directory(directory)
+                continue
+            if mtime == entry[1]:
+                continue
+            # A folder changed again within the mtime granularity would look
+            # unchanged, so one that just changed is listed once more.
+            entry[1] = None if time.time_ns() - mtime < 2e9 else mtime
+            for subdirectory in self.list_directory(directory, entry[0]):
+                if entry[0]["recursive"]:
+                    self.add_directory(subdirectory, entry[0])
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + event_header.size <= len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, name
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost; list every folder once to catch up.
+            for directory, entry in list(self.directories.items()):
+                self.list_directory(directory, entry[0])
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            # The folder itself was deleted or its file system unmounted.
+            del self.watches[wd]
+            self.forget_directory(directory)
+            return
+        rule = self.directories[directory][0]
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self.forget_directory(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and rule["recursive"] and not name.startswith("."):
+                self.add_directory(path, rule)
+            return
+        if not self.is_candidate(rule, name):
+            return
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+            self.known.pop(path, None)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.hand_over(path, rule)
+        else:
+            self.note_file(path, rule)
+
+    def run(self):
+        """Watch until stop() is called."""
+        if self.use_inotify:
+            fd = inotify.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            self.fd = fd if fd >= 0 else None
+        try:
+            # With nested rules the folders of the deepest one are its own.
+            for rule in sorted(self.rules, key=lambda rule: len(os.path.abspath(rule["path"])), reverse=True):
+                self.add_directory(rule["path"], rule, initial=True)
+            last_poll = time.monotonic()
+            while not self.is_stopped:
+                if self.fd is not None:
+                    if select.select([self.fd], [], [], watch_tick)[0]:
+                        for event in list(self.read_events()):
+                            self.handle_event(*event)
+                else:
+                    time.sleep(watch_tick)
+                if time.monotonic() - last_poll >= self.poll_interval:
+                    last_poll = time.monotonic()
+                    self.poll_directories()
+                self.check_pending()
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None